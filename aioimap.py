@@ -0,0 +1,558 @@
+import asyncio
+import imaplib
+import re
+import ssl
+import threading
+from collections import OrderedDict
+from imap_batch import (FETCH_CHUNK_SIZE, LITERAL_PATTERN, chunked, merge_uid_items, parse_fetch_response,
+                        quote_mailbox, to_sequence_set)
+
+# Longest response line accepted (long UID SEARCH results come on one line)
+LINE_LIMIT = 16 * 1024 * 1024
+
+TAGGED_PATTERN = re.compile(rb'^(\S+) (OK|NO|BAD)\b ?(.*)$', re.IGNORECASE)
+FETCH_PATTERN = re.compile(rb'^(\d+) FETCH ', re.IGNORECASE)
+FETCH_UID_PATTERN = re.compile(rb'\bUID (\d+)', re.IGNORECASE)
+CODE_PATTERN = re.compile(rb'^(?:OK|NO|BAD) \[([A-Z-]+) ?([^\]]*)\]', re.IGNORECASE)
+
+
+class _Command:
+    """A command waiting for its tagged completion"""
+
+    def __init__(self, tag, name, uids, future):
+        self.tag = tag
+        self.name = name
+        # UIDs a UID FETCH asked for, used to route untagged FETCH responses
+        self.uids = uids
+        self.future = future
+        self.data = []
+
+    def wants(self, uid):
+        """Whether an untagged FETCH for uid answers this UID FETCH"""
+        if self.name != 'UID FETCH':
+            return False
+        # An open-ended set (n:*) may return any UID, the highest one included
+        return self.uids is None or uid in self.uids
+
+
+def _sequence_uids(sequence_set):
+    """Expand a sequence set to a set of numbers, None if it is open-ended"""
+    if '*' in sequence_set:
+        return None
+    numbers = set()
+    for item in sequence_set.split(','):
+        first, _, last = item.partition(':')
+        numbers.update(range(int(first), int(last or first) + 1))
+    return numbers
+
+
+def _quote(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AsyncIMAPClient:
+    """
+    asyncio IMAP client that pipelines commands on one connection.
+
+    Any number of commands may be in flight at once: each is written as soon
+    as it is issued and awaits its own tagged completion. Untagged SEARCH and
+    FETCH responses are handed to the command that asked for them (FETCH
+    responses by UID when several UID FETCHes overlap), so the results look
+    like imaplib's (status, data) pairs and can be parsed with imap_batch.
+
+    Args:
+        host (str): IMAP server hostname
+        port (int): IMAP server port
+        use_ssl (bool): Connect with TLS (IMAPS)
+        timeout (float): Seconds allowed to connect
+        command_timeout (float): Seconds a command may wait for its completion
+            before the connection is considered dead and closed
+    """
+
+    abort = imaplib.IMAP4.abort
+    error = imaplib.IMAP4.error
+
+    def __init__(self, host, port=993, use_ssl=True, timeout=30, command_timeout=60):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.capabilities = ()
+        self.untagged_responses = {}
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._pending = OrderedDict()
+        self._tag_number = 0
+        self._closed = None
+
+    @property
+    def is_open(self):
+        return self._closed is None and self._read_task is not None and not self._read_task.done()
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.use_ssl else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context, limit=LINE_LIMIT), self.timeout)
+        try:
+            greeting = await asyncio.wait_for(self._reader.readline(), self.timeout)
+        except asyncio.TimeoutError:
+            self._writer.close()
+            raise self.abort('no greeting from server')
+        if not greeting.startswith(b'* OK'):
+            raise self.abort(f'unexpected greeting: {greeting!r}')
+        self._closed = None
+        self._read_task = asyncio.create_task(self._read_loop())
+        status, data = await self.command('CAPABILITY')
+        return status, data
+
+    async def command(self, name, *args):
+        """
+        Send a command and wait for its tagged completion.
+
+        Args:
+            name (str): Command name, e.g. "UID FETCH"
+            *args (str): Arguments, sent as given
+
+        Returns:
+            tuple: (status, data) as returned by imaplib
+
+        Raises:
+            IMAP4.abort: If the connection is lost before the command completes,
+                or it does not complete within command_timeout (the connection
+                is then closed, failing every other pending command too)
+        """
+        if not self.is_open:
+            raise self.abort(self._closed or 'not connected')
+        self._tag_number += 1
+        tag = f'A{self._tag_number:04d}'
+        uids = None
+        if name.upper() == 'UID FETCH' and args:
+            uids = _sequence_uids(args[0])
+        command = _Command(tag, name.upper(), uids, asyncio.get_running_loop().create_future())
+        self._pending[tag] = command
+        line = ' '.join((tag, name) + tuple(str(arg) for arg in args))
+        self._writer.write(line.encode() + b'\r\n')
+        try:
+            await asyncio.wait_for(self._writer.drain(), self.command_timeout)
+            status, text = await asyncio.wait_for(command.future, self.command_timeout)
+        except asyncio.TimeoutError:
+            # A silently dropped connection never answers: close it so the
+            # session reconnects instead of every caller waiting forever
+            self._close(f'{name} timed out')
+            raise self.abort(f'{name} timed out after {self.command_timeout}s')
+        if status == 'BAD':
+            raise self.error(f'{name} command error: {status} [{text!r}]')
+        if command.data:
+            return status, command.data
+        # Like imaplib: no untagged data for a SEARCH or FETCH gives [None]
+        return status, [None] if status == 'OK' and command.name.endswith(('SEARCH', 'FETCH')) else [text]
+
+    async def login(self, user, password):
+        status, data = await self.command('LOGIN', _quote(user), _quote(password))
+        if status != 'OK':
+            raise self.error(data[-1])
+        await self.command('CAPABILITY')
+        return status, data
+
+    async def select(self, mailbox='INBOX'):
+        self.untagged_responses.pop('UIDVALIDITY', None)
+        status, data = await self.command('SELECT', quote_mailbox(mailbox))
+        if status != 'OK':
+            raise self.error(f'SELECT failed: {data}')
+        return status, data
+
+    async def uid(self, command, *args):
+        """Run a UID command, e.g. uid('FETCH', '1:5', '(FLAGS)')"""
+        return await self.command(f'UID {command.upper()}', *args)
+
+    def response(self, code):
+        """Return and forget the values of an untagged response code, like imaplib"""
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    async def logout(self):
+        try:
+            if self.is_open:
+                await self.command('LOGOUT')
+        except Exception:
+            pass
+        finally:
+            self._close('logged out')
+
+    def _close(self, reason):
+        if self._closed is None:
+            self._closed = reason
+        if self._writer is not None:
+            self._writer.close()
+        for command in self._pending.values():
+            if not command.future.done():
+                command.future.set_exception(self.abort(reason))
+        self._pending.clear()
+
+    async def _read_response(self):
+        """Read one response, following literals; returns its imaplib-style parts"""
+        line = await self._reader.readline()
+        if not line:
+            raise self.abort('connection closed by server')
+        parts = []
+        line = line.rstrip(b'\r\n')
+        marker = LITERAL_PATTERN.search(line)
+        while marker:
+            literal = await self._reader.readexactly(int(marker.group(1)))
+            parts.append((line, literal))
+            line = (await self._reader.readline()).rstrip(b'\r\n')
+            marker = LITERAL_PATTERN.search(line)
+        parts.append(line)
+        return parts
+
+    async def _read_loop(self):
+        try:
+            while True:
+                parts = await self._read_response()
+                first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+                if first.startswith(b'* '):
+                    self._untagged(parts, first[2:])
+                elif first.startswith(b'+'):
+                    # No command here sends literals, so continuations are unexpected
+                    continue
+                else:
+                    match = TAGGED_PATTERN.match(first)
+                    if match:
+                        command = self._pending.pop(match.group(1).decode(), None)
+                        if command is not None and not command.future.done():
+                            command.future.set_result((match.group(2).decode().upper(), match.group(3)))
+        except asyncio.CancelledError:
+            self._close('connection closed')
+            raise
+        except Exception as e:
+            self._close(str(e) or e.__class__.__name__)
+
+    def _untagged(self, parts, text):
+        # Strip the "* " prefix of the first part, as imaplib does
+        if isinstance(parts[0], tuple):
+            parts[0] = (text, parts[0][1])
+        else:
+            parts[0] = text
+        upper = text.upper()
+
+        fetch = FETCH_PATTERN.match(text)
+        if fetch:
+            # UID may come after a literal, so look in every text segment
+            segments = [part[0] if isinstance(part, tuple) else part for part in parts]
+            uid = next((match for match in map(FETCH_UID_PATTERN.search, segments) if match), None)
+            command = self._route('FETCH', int(uid.group(1)) if uid else None)
+            if command is not None:
+                # imaplib drops the FETCH keyword: "12 (UID 34 ...)"
+                stripped = fetch.group(1) + b' ' + text[fetch.end():]
+                parts[0] = (stripped, parts[0][1]) if isinstance(parts[0], tuple) else stripped
+                command.data.extend(parts)
+            return
+        if upper.startswith(b'SEARCH'):
+            command = self._route('SEARCH')
+            if command is not None:
+                command.data.append(text[7:])
+            return
+        if upper.startswith(b'CAPABILITY '):
+            self.capabilities = tuple(text[11:].decode().upper().split())
+            return
+        if upper.startswith(b'BYE'):
+            self._close(text.decode(errors='ignore'))
+            return
+
+        # Unlike imaplib only the latest value of a response code is kept, and
+        # mailbox size updates ("42 EXISTS", "7 EXPUNGE") are dropped: nothing
+        # reads them, and a long-lived session would collect them forever
+        code = CODE_PATTERN.match(text)
+        if code:
+            self.untagged_responses[code.group(1).decode().upper()] = [code.group(2)]
+
+    def _route(self, kind, uid=None):
+        """
+        Pick the pending command an untagged response belongs to.
+
+        A FETCH goes to a UID FETCH that asked for its UID; unsolicited ones
+        (flag updates, other sessions' changes) match none and are dropped.
+        """
+        candidates = [command for command in self._pending.values() if command.name.endswith(kind)]
+        if kind == 'FETCH':
+            if uid is None:
+                return None
+            return next((command for command in candidates if command.wants(uid)), None)
+        return candidates[0] if candidates else None
+
+
+class AsyncIMAPSession:
+    """
+    One logged-in, pipelined IMAP session shared by every concurrent caller.
+
+    The session connects lazily, reconnects when the server drops it or a
+    command times out, and retries the interrupted command once. While idle it
+    sends a NOOP every keepalive_interval seconds, so a connection dropped
+    silently (e.g. by a NAT) is noticed before callers need it. Unlike the
+    connection pool, callers never wait for a free connection: their commands
+    are pipelined.
+
+    Args:
+        host (str): IMAP server hostname
+        user (str): Login username
+        password (str): Login password
+        mailbox (str): Mailbox selected after login
+        port (int): IMAP server port
+        use_ssl (bool): Connect with TLS (IMAPS)
+        max_in_flight (int): Most commands pipelined at once
+        command_timeout (float): Seconds a command may take before the connection is dropped
+        keepalive_interval (float): Idle seconds before a NOOP is sent, 0 to disable
+    """
+
+    def __init__(self, host, user, password, mailbox='inbox', port=993, use_ssl=True, max_in_flight=32,
+                 command_timeout=60, keepalive_interval=120):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.port = port
+        self.use_ssl = use_ssl
+        self.max_in_flight = max_in_flight
+        self.command_timeout = command_timeout
+        self.keepalive_interval = keepalive_interval
+        self.uidvalidity = None
+        self._client = None
+        self._connect_lock = None
+        self._slots = None
+        self._listeners = []
+        self._last_used = 0
+        self._keepalive_task = None
+
+    def on_uidvalidity_change(self, listener):
+        """Register listener(old, new), called when the mailbox UIDVALIDITY changes"""
+        self._listeners.append(listener)
+
+    async def _connected(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        async with self._connect_lock:
+            if self._client is None or not self._client.is_open:
+                client = AsyncIMAPClient(self.host, self.port, self.use_ssl, command_timeout=self.command_timeout)
+                try:
+                    await client.connect()
+                    await client.login(self.user, self.password)
+                    await client.select(self.mailbox)
+                except BaseException:
+                    client._close('login failed')
+                    raise
+                _, values = client.response('UIDVALIDITY')
+                if values and values[0]:
+                    uidvalidity = int(values[0])
+                    previous, self.uidvalidity = self.uidvalidity, uidvalidity
+                    if previous is not None and previous != uidvalidity:
+                        for listener in self._listeners:
+                            listener(previous, uidvalidity)
+                self._client = client
+                if self.keepalive_interval and (self._keepalive_task is None or self._keepalive_task.done()):
+                    self._keepalive_task = asyncio.create_task(self._keepalive())
+            return self._client
+
+    async def _keepalive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            client = self._client
+            if client is None or not client.is_open or loop.time() - self._last_used < self.keepalive_interval:
+                continue
+            try:
+                await client.command('NOOP')
+            except (AsyncIMAPClient.abort, AsyncIMAPClient.error, OSError):
+                # The client closed itself; the next command reconnects
+                pass
+
+    async def connect(self):
+        """Open the session now instead of on the first command"""
+        await self._connected()
+
+    @property
+    def capabilities(self):
+        return self._client.capabilities if self._client is not None else ()
+
+    async def uid(self, command, *args):
+        """Run a UID command on the shared session, reconnecting once if it was dropped"""
+        for attempt in (1, 2):
+            client = await self._connected()
+            self._last_used = asyncio.get_running_loop().time()
+            try:
+                async with self._slots:
+                    return await client.uid(command, *args)
+            except (AsyncIMAPClient.abort, OSError):
+                if attempt == 2:
+                    raise
+
+    async def close(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        if self._client is not None:
+            await self._client.logout()
+            self._client = None
+
+
+class EventLoopThread(threading.Thread):
+    """
+    Background thread running an event loop that owns the async IMAP sessions.
+
+    Coroutines can be run on it from plain threads with run(), or awaited from
+    any other event loop (e.g. one created for an async Flask view) with call().
+    """
+
+    def __init__(self):
+        super().__init__(name='imap-async', daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        self.loop.run_forever()
+
+    def ensure_started(self):
+        if not self._started.is_set():
+            with self._start_lock:
+                if not self.is_alive() and not self._started.is_set():
+                    self.start()
+            self._started.wait()
+
+    def run_coroutine(self, coro, timeout=None):
+        """Run a coroutine on the loop and block until it finishes"""
+        self.ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def call(self, coro):
+        """Await a coroutine on the loop from another event loop"""
+        self.ensure_started()
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+
+class MultiplexedIMAP:
+    """
+    Thread-safe, imaplib-style facade over an AsyncIMAPSession.
+
+    Any number of threads may call uid() at the same time: their commands are
+    pipelined on the session's one connection and each thread gets back its
+    own results, instead of queueing for a connection or behind each other.
+    It can be passed wherever imap_batch and imap_mime expect an imaplib
+    connection with the mailbox selected.
+
+    Args:
+        session (AsyncIMAPSession): Session to multiplex
+        loop_thread (EventLoopThread): Loop the session runs on
+    """
+
+    abort = imaplib.IMAP4.abort
+    error = imaplib.IMAP4.error
+
+    def __init__(self, session, loop_thread):
+        self.session = session
+        self.loop_thread = loop_thread
+
+    @property
+    def capabilities(self):
+        if not self.session.capabilities:
+            self.loop_thread.run_coroutine(self.session.connect())
+        return self.session.capabilities
+
+    def uid(self, command, *args):
+        """Run a UID command, e.g. uid('FETCH', '1:5', '(FLAGS)'), blocking only this thread"""
+        return self.loop_thread.run_coroutine(self.session.uid(command, *args))
+
+
+async def search_uids_async(session, *criteria):
+    """Async counterpart of imap_batch.search_uids"""
+    status, data = await session.uid('SEARCH', *criteria)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f'UID SEARCH failed: {data}')
+    return sorted(int(uid) for uid in b' '.join(part for part in data if part).split())
+
+
+async def fetch_batched_async(session, ids, message_parts, chunk_size=None):
+    """
+    Async counterpart of imap_batch.fetch_batched with uid=True.
+
+    All chunks are pipelined at once instead of waiting for each other.
+
+    Returns:
+        list: (UID, dict of fetched items) pairs in the order they arrived
+    """
+    async def fetch(chunk):
+        status, data = await session.uid('FETCH', to_sequence_set(chunk), message_parts)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+        return merge_uid_items(parse_fetch_response(data), chunk)
+
+    results = await asyncio.gather(*(fetch(chunk) for chunk in chunked(ids, chunk_size or FETCH_CHUNK_SIZE)))
+    return [item for chunk in results for item in chunk]
+
+
+def benchmark(host, user, password, port=993, use_ssl=True, requests=200, callers=32, connection_counts=(1, 2, 4, 8)):
+    """
+    Compare request throughput of pooled imaplib connections with one multiplexed session.
+
+    Each request is the UID FETCH behind an email page (BODYSTRUCTURE and
+    header) of one of the newest emails; callers threads issue them at once.
+
+    Returns:
+        list: (label, connections, requests per second) rows
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from imap_pool import IMAPConnectionPool
+    from imap_batch import fetch_batched, search_uids
+
+    items = '(BODYSTRUCTURE BODY.PEEK[HEADER])'
+    rows = []
+
+    def measure(label, connections, fetch):
+        with ThreadPoolExecutor(max_workers=callers) as executor:
+            list(executor.map(fetch, uids[:callers]))  # warm up: connect and log in
+            started = time.perf_counter()
+            list(executor.map(fetch, (uids[i % len(uids)] for i in range(requests))))
+            elapsed = time.perf_counter() - started
+        rows.append((label, connections, requests / elapsed))
+        print(f"{label:<12} {connections:>11} {requests / elapsed:>12.1f}")
+
+    print(f"{'mode':<12} {'connections':>11} {'requests/s':>12}")
+    for connections in connection_counts:
+        pool = IMAPConnectionPool(host, user, password, port=port, max_size=connections, wait_timeout=300)
+        if connections == connection_counts[0]:
+            with pool.connection() as mail:
+                uids = search_uids(mail, 'ALL')[-50:]
+            if not uids:
+                raise ValueError('The mailbox is empty, nothing to fetch')
+
+        def pooled_fetch(uid):
+            with pool.connection() as mail:
+                return list(fetch_batched(mail, [uid], items, uid=True))
+
+        measure('pool', connections, pooled_fetch)
+        pool.close_all()
+
+    loop_thread = EventLoopThread()
+    session = AsyncIMAPSession(host, user, password, port=port, use_ssl=use_ssl, max_in_flight=callers)
+    mux = MultiplexedIMAP(session, loop_thread)
+    measure('multiplexed', 1, lambda uid: list(fetch_batched(mux, [uid], items, uid=True)))
+    loop_thread.run_coroutine(session.close())
+    return rows
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    benchmark(
+        os.getenv('IMAP_SERVER') or 'imapmail.libero.it',
+        os.getenv('BASE_EMAIL'),
+        os.getenv('BASE_PASSWORD'),
+        requests=int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+    )
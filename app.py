@@ -1,11 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, jsonify
-import imaplib
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, jsonify, Response, make_response
+from werkzeug.http import is_resource_modified
+import asyncio
 import hashlib
 import email
-from email.header import decode_header
 import os
-import re
+import json
+import base64
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
 from dotenv import load_dotenv
+from imap_pool import IMAPConnectionPool
+from imap_batch import fetch_batched
+from imap_mime import (IDENTITY_ENCODINGS, parse_bodystructure, find_text_part, list_attachments,
+                       fetch_section, binary_size, decode_chunks, decode_text_part)
+from aioimap import AsyncIMAPSession, EventLoopThread, MultiplexedIMAP, search_uids_async, fetch_batched_async
+from mail_index import MailIndex, IndexSyncWorker, IndexNotifier, header_summary, recipient_hashes, RECIPIENT_FETCH_ITEMS
+from message_cache import create_cache
+from shards import load_shards, shard_index
+from email_render import RENDER_VERSION, render_body, render_key
+from email_headers import decode_header_text, parse_date_header
 
 # Load environment variables from .env file
 load_dotenv()
@@ -28,157 +42,457 @@ print(f"Password: {PASSWORD}")
 # Libero.it IMAP settings
 IMAP_SERVER = 'imapmail.libero.it'
 
-def extract_email_from_to_field(to_field):
+# Backing mailboxes; every alias lives in the shard picked by its hash prefix
+SHARDS = load_shards()
+
+# One background event loop drives the pipelined session of every shard
+imap_loop = EventLoopThread()
+
+# Emails per page on /search
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 25))
+
+# Most bytes of an email body downloaded and shown; longer bodies are cut
+MAX_BODY_SIZE = int(os.getenv('MAX_BODY_SIZE', 1024 * 1024))
+
+# Longest a long-poll or a single SSE wait may block, in seconds
+LONG_POLL_MAX_WAIT = 60
+SSE_KEEPALIVE_INTERVAL = 15
+
+# Parsed messages keyed by UIDVALIDITY and UID, so reopening an email skips the IMAP fetch.
+# Use the disk or redis backend to share it between several app workers.
+message_cache = create_cache(
+    backend=os.getenv('CACHE_BACKEND', 'memory'),
+    path=os.getenv('CACHE_PATH', 'ghostinbox_cache.sqlite3'),
+    url=os.getenv('CACHE_URL', 'redis://localhost:6379/0'),
+    max_bytes=int(os.getenv('MESSAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    ttl=float(os.getenv('MESSAGE_CACHE_TTL', 3600)),
+)
+
+# Seconds a list fetched straight from IMAP (no index) is reused
+LIST_CACHE_TTL = float(os.getenv('LIST_CACHE_TTL', 10))
+
+# Seconds browsers and API clients may reuse an email without revalidating it.
+# Lists are always revalidated, new mail can arrive at any moment.
+HTTP_MESSAGE_MAX_AGE = int(os.getenv('HTTP_MESSAGE_MAX_AGE', 300))
+
+class MailboxBackend:
+    """
+    The IMAP sessions and local index serving the aliases of one shard.
+
+    Attributes:
+        shard (Shard): Mailbox served
+        imap_pool (IMAPConnectionPool): Sessions for the index worker and IDLE watcher
+        imap_session (AsyncIMAPSession): Pipelined session serving the async routes
+        imap_mux (MultiplexedIMAP): The same session for plain (sync) code
+        mail_index (MailIndex): Local metadata index, None when disabled
+        mail_notifier (IndexNotifier): Wakes clients waiting for new mail, None without index
+    """
+
+    def __init__(self, shard):
+        self.shard = shard
+        # Shared pool of logged-in IMAP sessions for the index worker and IDLE watcher
+        self.imap_pool = IMAPConnectionPool(
+            shard.server, shard.user, shard.password,
+            max_size=int(os.getenv('IMAP_POOL_SIZE', 4)),
+            idle_timeout=float(os.getenv('IMAP_POOL_IDLE_TIMEOUT', 300)),
+            wait_timeout=float(os.getenv('IMAP_POOL_WAIT_TIMEOUT', 10)),
+            mailbox=shard.mailbox, port=shard.port,
+        )
+        # One pipelined session serves the async routes: concurrent lookups
+        # share it instead of each holding a connection
+        self.imap_session = AsyncIMAPSession(
+            shard.server, shard.user, shard.password, mailbox=shard.mailbox, port=shard.port,
+            max_in_flight=int(os.getenv('IMAP_PIPELINE_DEPTH', 32)),
+            command_timeout=float(os.getenv('IMAP_COMMAND_TIMEOUT', 60)),
+            keepalive_interval=float(os.getenv('IMAP_KEEPALIVE_INTERVAL', 120)),
+        )
+        # The same session for plain (sync) code: threads pipeline their commands on it
+        self.imap_mux = MultiplexedIMAP(self.imap_session, imap_loop)
+        self.imap_pool.on_uidvalidity_change(lambda old, new: message_cache.clear())
+        self.imap_session.on_uidvalidity_change(lambda old, new: message_cache.clear())
+
+        # Local metadata index answering alias lookups without a server-side SEARCH
+        self.mail_index = None
+        self.mail_notifier = None
+        if os.getenv('INDEX_ENABLED', '1') == '1':
+            self.mail_index = MailIndex(shard.path(os.getenv('INDEX_PATH', 'ghostinbox_index.sqlite3'), len(SHARDS)))
+            # Wakes clients waiting for new mail (/api/stream, /api/search?wait=)
+            self.mail_notifier = IndexNotifier(self.mail_index, on_expunge=self.on_index_expunge)
+            self.mail_notifier.start()
+            # New mail is pushed into the index by an IDLE watcher; polling is only a fallback
+            index_idle = os.getenv('INDEX_IDLE', '1') == '1'
+            self.index_sync_worker = IndexSyncWorker(
+                self.mail_index, self.imap_pool,
+                interval=float(os.getenv('INDEX_SYNC_INTERVAL', 60 if index_idle else 10)),
+                idle=index_idle,
+                on_sync=self.on_index_sync,
+            )
+            self.index_sync_worker.start()
+
+    def cache_key(self, kind, *parts):
+        """Build a message cache key; UIDs only identify an email within one shard"""
+        return ':'.join([kind, str(self.shard.number), *map(str, parts)])
+
+    def on_index_sync(self, result):
+        """Wake waiting clients; expunges are applied by the notifier of every process"""
+        self.mail_notifier.notify(result)
+
+    def on_index_expunge(self, uids):
+        """Forget cached messages that were expunged, whichever process synced the index"""
+        for uid in uids:
+            message_cache.invalidate(self.cache_key('message', self.mail_index.uidvalidity, uid))
+            message_cache.invalidate(self.cache_key('parts', self.mail_index.uidvalidity, uid))
+
+    def index_ready(self):
+        return self.mail_index is not None and self.mail_index.is_ready()
+
+    def current_uidvalidity(self):
+        """UIDVALIDITY of the mailbox email IDs are currently taken from"""
+        if self.index_ready():
+            return self.mail_index.uidvalidity
+        return self.imap_session.uidvalidity
+
+backends = [MailboxBackend(shard) for shard in SHARDS]
+
+def backend_for(hash):
+    """Return the backend of the shard holding the emails of an alias hash"""
+    return backends[shard_index(hash, len(backends))]
+
+# Only the headers shown in list views are fetched, never the message body
+LIST_FETCH_ITEMS = '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT DATE)])'
+
+def encode_cursor(email_item):
+    """Build the opaque pagination cursor pointing after an email"""
+    token = f"{email_item['uidvalidity']}:{email_item['id']}"
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, hash):
     """
-    Extract email address from the 'to' field which can be either:
-    - Plain email: "user@example.com"
-    - Formatted: '"Name Surname" <user@example.com>'
+    Decode a pagination cursor back to the UID it points after.
 
     Args:
-        to_field (str): The 'to' field content
+        cursor (str): Cursor returned as next_cursor
+        hash (str): sha256 hash of the alias being listed
 
     Returns:
-        str: The extracted email address or None if not found
+        int: UID; the next page holds emails with lower UIDs
+
+    Raises:
+        ValueError: If the cursor is malformed or the mailbox UIDVALIDITY changed
     """
-    if not to_field:
+    try:
+        token = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        uidvalidity, uid = token.split(':')
+        uid = int(uid)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    current = backend_for(hash).current_uidvalidity()
+    if current is not None and uidvalidity != str(current):
+        raise ValueError('Cursor expired, the mailbox has been rebuilt')
+    return uid
+
+def make_etag(*parts):
+    """Opaque entity tag of a response identified by parts"""
+    return hashlib.sha256(':'.join(map(str, parts)).encode()).hexdigest()
+
+def to_datetime(timestamp):
+    """UTC datetime of a UNIX timestamp for Last-Modified, None if unknown or in the future"""
+    if not timestamp or timestamp > time.time():
         return None
+    return datetime.fromtimestamp(int(timestamp), timezone.utc)
 
-    # Pattern to match email addresses
-    # This regex handles both plain emails and emails within angle brackets
-    email_pattern = r'<([^>]+)>|([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})'
+def list_validator(backend, hash, *page):
+    """
+    Validators of a list of emails of an alias, read from the local index only.
 
-    match = re.search(email_pattern, to_field)
-    if match:
-        # Return the first non-None group (either from angle brackets or plain email)
-        return match.group(1) if match.group(1) else match.group(2)
+    Args:
+        backend (MailboxBackend): Shard of the alias
+        hash (str): sha256 hash of the alias
+        *page: What else shapes the response, e.g. the route, limit and cursor
 
-    return None
+    Returns:
+        tuple: (ETag, Last-Modified datetime or None), or None when the index
+            is not ready and a validator would need IMAP work
+    """
+    if not backend.index_ready():
+        return None
+    count, max_uid = backend.mail_index.alias_state(hash)
+    etag = make_etag('list', hash, backend.mail_index.uidvalidity, count, max_uid, *page)
+    return etag, to_datetime(backend.mail_index.last_change)
 
-def get_emails(limit=0, hash=None):
-    try:
-        # Connect to Libero.it IMAP server
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
-        mail.login(EMAIL_ADDRESS, PASSWORD)
-        mail.select('inbox')  # Select the inbox folder
+def message_etag(kind, hash, uidvalidity, uid):
+    """
+    ETag of one email. Its content never changes for a given UIDVALIDITY and
+    UID; the alias hash is included so a tag only matches for an alias the
+    email was already served to.
+    """
+    return make_etag(kind, hash, uidvalidity, uid, RENDER_VERSION)
+
+def message_validator(backend, hash, email_id, kind):
+    """
+    Validators of an email known to exist without asking the IMAP server.
+
+    With the index ready the email must be indexed and owned by hash. Without
+    it, the email must be in the message cache; its ownership is then only
+    proven by an ETag carrying the hash, so no Last-Modified is given.
+
+    Returns:
+        tuple: (ETag, Last-Modified datetime or None), or None if unknown
+    """
+    if not str(email_id).isdigit():
+        return None
+    uid = int(email_id)
+    if backend.index_ready():
+        summary = backend.mail_index.get(uid)
+        if summary is None or not backend.mail_index.owns(hash, uid):
+            return None
+        return message_etag(kind, hash, summary['uidvalidity'], uid), to_datetime(parse_date_header(summary['date']))
+    uidvalidity = backend.imap_session.uidvalidity
+    if uidvalidity is None or message_cache.get(backend.cache_key('message', uidvalidity, uid)) is None:
+        return None
+    return message_etag(kind, hash, uidvalidity, uid), None
+
+def with_validators(response, validator, max_age=0):
+    """
+    Add ETag, Last-Modified and Cache-Control to a response and turn it into
+    304 Not Modified when If-None-Match or If-Modified-Since match.
+
+    Args:
+        response (Response): Full response
+        validator (tuple): (ETag, Last-Modified) or None to tag the body itself
+        max_age (int): Seconds the client may reuse the response, 0 to revalidate every time
+    """
+    if validator is None:
+        response.add_etag()
+    else:
+        etag, last_modified = validator
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+    # Aliases travel in the URL, shared caches must not keep the responses
+    response.cache_control.private = True
+    if max_age > 0:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def not_modified(validator, max_age=0):
+    """Return a 304 response when the client copy matches validator, before any IMAP work, else None"""
+    if validator is None:
+        return None
+    etag, last_modified = validator
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return with_validators(Response(status=304), validator, max_age)
+
+async def get_emails(limit=0, hash=None, before=None):
+    """
+    List emails sent to a hash address without downloading their bodies.
 
-        # Search for all emails in the inbox
-        status, data = mail.search(None, "TO", f'{hash}@ghostinbox.it')
+    Args:
+        limit (int): Maximum number of (newest) emails to return, 0 for all
+        hash (str): sha256 hash of the alias
+        before (int): Only return emails with a UID below this one (next page)
+
+    Returns:
+        list: Email header dicts (id, from, to, subject, date, size), newest first.
+            The id is the message UID, which stays valid across expunges for as
+            long as the mailbox UIDVALIDITY is unchanged.
+    """
+    backend = backend_for(hash)
+    imap_session = backend.imap_session
+
+    # Answer from the local index once it has been populated
+    if backend.index_ready():
+        return backend.mail_index.search(hash, limit, before=before)
+
+    cache_key = backend.cache_key('list', imap_session.uidvalidity, hash, limit, before)
+    if imap_session.uidvalidity is not None:
+        cached = message_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    async def fetch_list():
+        # Search for all emails in the inbox, then fetch only the requested page
+        email_ids = await search_uids_async(imap_session, "TO", f'{hash}@ghostinbox.it')
+        if before is not None:
+            email_ids = [uid for uid in email_ids if uid < before]
         if limit > 0:
-            email_ids = data[0].split()[-limit:]
-        else:
-            email_ids = data[0].split()
-
-        emails = []
-        for email_id in email_ids:
-            # Fetch email by ID
-            status, msg_data = mail.fetch(email_id, '(RFC822)')
-            msg = email.message_from_bytes(msg_data[0][1])
-
-            # Get email subject
-            subject, encoding = decode_header(msg['subject'])[0]
-            if isinstance(subject, bytes):
-                subject = subject.decode(encoding or 'utf-8', errors='ignore')
-
-            # Get sender
-            from_ = msg.get('from')
-
-            # Get email date
-            date_ = msg.get('date')
-
-            # Get email body (prefer plain text, fall back to HTML)
-            body = ''
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type == 'text/plain':
-                        body = part.get_payload(decode=True).decode(errors='ignore')
-                        break
-                    elif content_type == 'text/html' and not body:
-                        body = part.get_payload(decode=True).decode(errors='ignore')
-            else:
-                body = msg.get_payload(decode=True).decode(errors='ignore')
-
-            # Get receiver
-            to_ = msg.get('to')
-
-            # Store email info
-            emails.append({
-                'id': email_id.decode(),
-                'from': from_,
-                'to': to_,
-                'subject': subject,
-                'date': date_,
-                'body': body
-            })
-
-        mail.logout()
-        return emails[::-1]  # Reverse to show newest emails first
+            email_ids = email_ids[-limit:]
+        # Fetch headers and size only, all chunks pipelined on the shared session
+        return await fetch_batched_async(imap_session, email_ids, LIST_FETCH_ITEMS)
+
+    try:
+        emails = [{
+            'id': str(email_id),
+            'uidvalidity': imap_session.uidvalidity,
+            **header_summary(items)
+        } for email_id, items in await imap_loop.call(fetch_list())]
+
+        # Show newest emails first
+        emails.sort(key=lambda item: int(item['id']), reverse=True)
+        message_cache.put(backend.cache_key('list', imap_session.uidvalidity, hash, limit, before), emails,
+                          ttl=LIST_CACHE_TTL)
+        return emails
 
     except Exception as e:
         print(f"Error: {e}")
         return []
 
-def get_email_by_id(email_id):
-    try:
-        # Connect to Libero.it IMAP server
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
-        mail.login(EMAIL_ADDRESS, PASSWORD)
-        mail.select('inbox')  # Select the inbox folder
+async def get_email_by_id(email_id, hash):
+    """
+    Fetch and parse a full email by UID.
 
-        # Fetch email by ID
-        status, msg_data = mail.fetch(email_id, '(RFC822)')
-        msg = email.message_from_bytes(msg_data[0][1])
+    Args:
+        email_id (str): Message UID as returned by get_emails()
+        hash (str): sha256 hash of the alias, which picks the shard
 
-        # Get email subject
-        subject, encoding = decode_header(msg['subject'])[0]
-        if isinstance(subject, bytes):
-            subject = subject.decode(encoding or 'utf-8', errors='ignore')
+    Returns:
+        dict: Parsed email, or None if the UID is invalid or no longer exists
+    """
+    if not str(email_id).isdigit():
+        return None
 
-        # Get sender
-        from_ = msg.get('from')
+    backend = backend_for(hash)
+    imap_session = backend.imap_session
+    cache_key = backend.cache_key('message', imap_session.uidvalidity, int(email_id))
+    if imap_session.uidvalidity is not None:
+        cached = message_cache.get(cache_key)
+        if cached is not None:
+            rendered = message_cache.get(f"rendered:{cached['digest']}")
+            if rendered is not None:
+                return {**cached, **rendered}
+
+    async def fetch_email(uid):
+        # Headers and MIME structure first, then only the text part to display
+        fetched = dict(await fetch_batched_async(imap_session, [uid], '(BODYSTRUCTURE BODY.PEEK[HEADER])'))
+        if uid not in fetched:
+            return None, None, []
+        part = find_text_part(parse_bodystructure(fetched[uid].get('BODYSTRUCTURE')))
+        if not part:
+            return fetched[uid], None, []
+        section = dict(await fetch_batched_async(
+            imap_session, [uid], f"(BODY.PEEK[{part['section']}]<0.{MAX_BODY_SIZE}>)"))
+        chunks = [bytes(value) for key, value in section.get(uid, {}).items() if key.startswith('BODY[') and value]
+        return fetched[uid], part, chunks
 
-        # Get email date
-        date_ = msg.get('date')
+    try:
+        items, part, chunks = await imap_loop.call(fetch_email(int(email_id)))
+        if items is None:
+            message_cache.invalidate(cache_key)
+            return None
 
         # Get email body (prefer plain text, fall back to HTML)
         body = ''
         content_type = ''
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                if content_type == 'text/plain':
-                    body = part.get_payload(decode=True).decode(errors='ignore')
-                    break
-                elif content_type == 'text/html' and not body:
-                    body = part.get_payload(decode=True).decode(errors='ignore')
-        else:
-            body = msg.get_payload(decode=True).decode(errors='ignore')
-            content_type = msg.get_content_type()
+        truncated = False
+        if part:
+            body, truncated = decode_text_part(part, chunks, MAX_BODY_SIZE)
+            content_type = part['type']
 
-        # Get receiver
-        to_ = msg.get('to')
+        msg = email.message_from_bytes(items.get('BODY[HEADER]') or b'')
+
+        # Get email subject
+        subject = decode_header_text(msg.get('subject'), 'No Subject')
+
+        # Get sender
+        from_ = decode_header_text(msg.get('from'))
+
+        # Get email date
+        date_ = decode_header_text(msg.get('date'))
 
-        mail.logout()
-        return {
-            'id': email_id,
+        # Get receiver
+        to_ = decode_header_text(msg.get('to'))
+
+        # Sanitize once per distinct body; the same newsletter sent to many
+        # aliases is rendered and cached a single time
+        rendered_key = f"rendered:{render_key(body, content_type, truncated)}"
+        rendered = message_cache.get(rendered_key)
+        if rendered is None:
+            rendered = render_body(body, content_type, truncated)
+            message_cache.put(rendered_key, rendered)
+
+        email_data = {
+            'id': str(email_id),
+            'uidvalidity': imap_session.uidvalidity,
             'from': from_,
             'to': to_,
             'subject': subject,
             'date': date_,
-            'body': body,
-            'content_type': content_type
+            'digest': rendered['digest']
         }
+        message_cache.put(backend.cache_key('message', email_data['uidvalidity'], int(email_id)), email_data)
+        return {**email_data, **rendered}
 
     except Exception as e:
         print(f"Error fetching email {email_id}: {e}")
         return None
 
+def owns_email(email_id, hash):
+    """
+    Check that an email was sent to a hash address before anything else of it is fetched.
+
+    Answered in memory by the local index whenever it covers the UID; otherwise
+    only the recipient headers (To, Cc, Delivered-To, X-Original-To) are fetched.
+
+    Args:
+        email_id (str): Message UID as returned by get_emails()
+        hash (str): sha256 hash of the alias
+
+    Returns:
+        bool: True if the email exists and one of its recipients is the hash address
+    """
+    if not str(email_id).isdigit():
+        return False
+    backend = backend_for(hash)
+    if backend.index_ready():
+        owned = backend.mail_index.owns(hash, int(email_id))
+        if owned is not None:
+            return owned
+    fetched = dict(fetch_batched(backend.imap_mux, [email_id], RECIPIENT_FETCH_ITEMS, uid=True))
+    return int(email_id) in fetched and hash.lower() in recipient_hashes(fetched[int(email_id)])
+
+def get_email_parts(email_id, hash):
+    """
+    Fetch the MIME parts of an email without downloading any content.
+
+    Args:
+        email_id (str): Message UID as returned by get_emails()
+        hash (str): sha256 hash of the alias, which picks the shard
+
+    Returns:
+        dict: 'parts' as returned by parse_bodystructure(), or None if the UID
+            is invalid or no longer exists
+    """
+    if not str(email_id).isdigit():
+        return None
+
+    backend = backend_for(hash)
+    uidvalidity = backend.imap_session.uidvalidity
+    cache_key = backend.cache_key('parts', uidvalidity, int(email_id))
+    if uidvalidity is not None:
+        cached = message_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    fetched = dict(fetch_batched(backend.imap_mux, [email_id], '(BODYSTRUCTURE)', uid=True))
+    if int(email_id) not in fetched:
+        message_cache.invalidate(cache_key)
+        return None
+
+    email_parts = {
+        'parts': parse_bodystructure(fetched[int(email_id)].get('BODYSTRUCTURE'))
+    }
+    message_cache.put(backend.cache_key('parts', backend.imap_session.uidvalidity, int(email_id)), email_parts)
+    return email_parts
+
 @app.route('/')
 def index():
     return render_template('index.html', domain=DOMAIN, onion_domain=ONION_DOMAIN)
 
 @app.route('/email/<email_id>')
-def view_email(email_id):
+async def view_email(email_id):
     alias = request.args.get('alias', '').strip()
 
     if not alias or len(alias) < 8:
@@ -186,27 +500,31 @@ def view_email(email_id):
         return redirect(url_for('index'))
     
     hash = hashlib.sha256(alias.encode()).hexdigest()
-        
-    email_data = get_email_by_id(email_id)
-    if not email_data:
-        flash('Email not found', 'error')
-        return redirect(url_for('index'))
-        
-    # Extract the actual email address from the 'to' field
-    extracted_email = extract_email_from_to_field(email_data['to'])
 
-    # Check if the extracted email matches the hash
-    if extracted_email != f'{hash}@ghostinbox.it':
+    cached_copy = not_modified(message_validator(backend_for(hash), hash, email_id, 'page'), HTTP_MESSAGE_MAX_AGE)
+    if cached_copy is not None:
+        return cached_copy
+
+    # Check the email was sent to the hash before fetching it
+    if not await asyncio.to_thread(owns_email, email_id, hash):
         flash('Email not found, wrong hash', 'error')
         return redirect(url_for('index'))
+
+    email_data = await get_email_by_id(email_id, hash)
+    if not email_data:
+        flash('Email not found', 'error')
+        return redirect(url_for('index'))
     
     # Store the hash in session for subsequent requests
     session['hash'] = hash
 
-    return render_template('email_view.html', email=email_data, hash=hash, domain=DOMAIN, onion_domain=ONION_DOMAIN)
+    response = make_response(render_template('email_view.html', email=email_data, hash=hash, domain=DOMAIN, onion_domain=ONION_DOMAIN))
+    validator = (message_etag('page', hash, email_data['uidvalidity'], int(email_id)),
+                 to_datetime(parse_date_header(email_data['date'])))
+    return with_validators(response, validator, HTTP_MESSAGE_MAX_AGE)
 
 @app.route('/search')
-def search_alias():
+async def search_alias():
     alias = request.args.get('alias', '').strip()
 
     if not alias or len(alias) < 8:
@@ -216,15 +534,29 @@ def search_alias():
     hash = hashlib.sha256(alias.encode()).hexdigest()
 
     try:
-        emails = get_emails(limit=0, hash=hash)
+        cursor = request.args.get('cursor', '')
+        before = decode_cursor(cursor, hash) if cursor else None
+
+        # Read before the emails, so a change in between only costs one extra full response
+        validator = list_validator(backend_for(hash), hash, 'page', SEARCH_PAGE_SIZE, cursor)
+        cached_copy = not_modified(validator)
+        if cached_copy is not None:
+            return cached_copy
 
-        return render_template('search_results.html', 
+        # One extra email tells whether an older page exists
+        page = await get_emails(limit=SEARCH_PAGE_SIZE + 1, hash=hash, before=before)
+        emails = page[:SEARCH_PAGE_SIZE]
+        next_cursor = encode_cursor(emails[-1]) if len(page) > SEARCH_PAGE_SIZE else None
+
+        return with_validators(make_response(render_template('search_results.html', 
                              emails=emails, 
+                             cursor=cursor,
+                             next_cursor=next_cursor,
                              alias=alias,
                              email=f'{hash}@ghostinbox.it',
                              hash=hash,
                              domain=DOMAIN,
-                             onion_domain=ONION_DOMAIN)
+                             onion_domain=ONION_DOMAIN)), validator)
     except Exception as e:
         flash(f'Error searching emails: {str(e)}', 'error')
         return redirect(url_for('index'))
@@ -239,12 +571,17 @@ def about():
 
 # API Routes
 @app.route('/api/search')
-def api_list_emails():
+async def api_list_emails():
     """
     API endpoint to get list of emails.
     Query parameters:
     - alias: required alias to filter emails by alias
     - limit: optional limit of emails to return (default: 10)
+    - cursor: optional next_cursor of a previous response, to get the next
+      (older) page
+    - wait: optional seconds (max 60) to wait for an email newer than since
+    - since: optional email ID; with wait, only newer emails end the wait
+      (default: the newest email currently listed)
     """
     alias = request.args.get('alias', '').strip()
 
@@ -253,27 +590,57 @@ def api_list_emails():
         return redirect(url_for('index'))
     
     hash = hashlib.sha256(alias.encode()).hexdigest()
-    limit = int(request.args.get('limit', 10))
-    
+    cursor = request.args.get('cursor', '')
+
     try:
-        emails = get_emails(limit=0, hash=hash)[:limit]
-
-        # Remove body from list endpoint for performance
-        email_list = []
-        for email_item in emails:
-            email_list.append({
-                'id': email_item['id'],
-                'from': email_item['from'],
-                'to': email_item['to'],
-                'subject': email_item['subject'],
-                'date': email_item['date']
-            })
-        
+        limit = max(int(request.args.get('limit', 10)), 1)
+        wait = min(float(request.args.get('wait', 0)), LONG_POLL_MAX_WAIT)
+    except ValueError:
         return jsonify({
+            'success': False,
+            'error': 'limit and wait must be numbers'
+        }), 400
+
+    try:
+        before = decode_cursor(cursor, hash) if cursor else None
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    try:
+        backend = backend_for(hash)
+        long_poll = wait > 0 and before is None and backend.index_ready()
+
+        # Read before the emails, so a change in between only costs one extra full response.
+        # A long-poll waits for a change instead of answering 304 right away.
+        validator = list_validator(backend, hash, 'api', limit, cursor)
+        if not long_poll:
+            cached_copy = not_modified(validator)
+            if cached_copy is not None:
+                return cached_copy
+
+        # List entries carry headers and size only, never the body.
+        # One extra email tells whether an older page exists.
+        page = await get_emails(limit=limit + 1, hash=hash, before=before)
+
+        # Long-poll: block on the shard's notifier, not on the IMAP server
+        if long_poll:
+            since = request.args.get('since', '')
+            since = int(since) if since.isdigit() else max((int(item['id']) for item in page), default=0)
+            if await asyncio.to_thread(backend.mail_notifier.wait_for_new, hash, since, wait):
+                validator = list_validator(backend, hash, 'api', limit, cursor)
+                page = await get_emails(limit=limit + 1, hash=hash)
+
+        email_list = page[:limit]
+        return with_validators(jsonify({
             'success': True,
             'count': len(email_list),
-            'emails': email_list
-        })
+            'uidvalidity': backend.current_uidvalidity(),
+            'emails': email_list,
+            'next_cursor': encode_cursor(email_list[-1]) if len(page) > limit else None
+        }), validator)
     
     except Exception as e:
         return jsonify({
@@ -281,12 +648,85 @@ def api_list_emails():
             'error': str(e)
         }), 500
 
+@app.route('/api/stream')
+def api_stream_emails():
+    """
+    Server-Sent Events stream of new emails for an alias.
+    Query parameters:
+    - alias: required alias to watch
+    - since: optional email ID; emails with a higher ID are sent (default: the
+      newest current email, i.e. only mail arriving from now on). The standard
+      Last-Event-ID header takes precedence, so reconnecting clients resume.
+    """
+    alias = request.args.get('alias', '').strip()
+
+    if not alias or len(alias) < 8:
+        return jsonify({
+            'success': False,
+            'error': 'Alias is required to stream emails'
+        }), 400
+
+    hash = hashlib.sha256(alias.encode()).hexdigest()
+    backend = backend_for(hash)
+    if not backend.index_ready():
+        return jsonify({
+            'success': False,
+            'error': 'Streaming is not available'
+        }), 503
+
+    mail_index, mail_notifier = backend.mail_index, backend.mail_notifier
+    since = request.headers.get('Last-Event-ID') or request.args.get('since', '')
+    if since.isdigit():
+        since = int(since)
+    else:
+        since = max((int(item['id']) for item in mail_index.search(hash, limit=1)), default=0)
+
+    def generate(last_uid):
+        yield 'retry: 5000\n\n'
+        while True:
+            emails = mail_notifier.wait_for_new(hash, last_uid, SSE_KEEPALIVE_INTERVAL)
+            if not emails:
+                # Comment line keeps proxies from closing an idle connection
+                yield ': keepalive\n\n'
+                continue
+            for email_item in reversed(emails):
+                yield f"id: {email_item['id']}\nevent: email\ndata: {json.dumps(email_item)}\n\n"
+            last_uid = int(emails[0]['id'])
+
+    return Response(generate(since), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/metrics')
+def api_metrics():
+    """
+    API endpoint exposing IMAP connection pool and index metrics, per shard.
+    """
+    shards = [{
+        'shard': backend.shard.number,
+        'pool': backend.imap_pool.metrics(),
+        'index': backend.mail_index.stats() if backend.mail_index is not None else None,
+        'waiting_clients': backend.mail_notifier.waiting() if backend.mail_notifier is not None else 0
+    } for backend in backends]
+    return jsonify({
+        'success': True,
+        # The first shard's figures, as reported before sharding
+        'pool': shards[0]['pool'],
+        'message_cache': message_cache.stats(),
+        'index': shards[0]['index'],
+        'waiting_clients': sum(shard['waiting_clients'] for shard in shards),
+        'shards': shards
+    })
+
 @app.route('/api/emails/<email_id>')
-def api_get_email(email_id):
+async def api_get_email(email_id):
     """
     API endpoint to get a single email by ID.
     Query parameters:
     - alias: required alias to verify email ownership
+    - uidvalidity: optional UIDVALIDITY the ID was obtained under; a mismatch
+      means the mailbox was rebuilt and the ID no longer refers to the same email
     """
     alias = request.args.get('alias', '').strip()
 
@@ -295,31 +735,170 @@ def api_get_email(email_id):
         return redirect(url_for('index'))
     
     hash = hashlib.sha256(alias.encode()).hexdigest()
+    uidvalidity = request.args.get('uidvalidity', '').strip()
     
     try:
-        email_data = get_email_by_id(email_id)
+        backend = backend_for(hash)
+        if not uidvalidity or uidvalidity == str(backend.current_uidvalidity()):
+            cached_copy = not_modified(message_validator(backend, hash, email_id, 'api'), HTTP_MESSAGE_MAX_AGE)
+            if cached_copy is not None:
+                return cached_copy
+
+        # Check the email was sent to the hash before fetching it
+        if not await asyncio.to_thread(owns_email, email_id, hash):
+            return jsonify({
+                'success': False,
+                'error': 'Email not found or hash mismatch'
+            }), 403
+
+        email_data = await get_email_by_id(email_id, hash)
         
-        if not email_data:
+        if not email_data or (uidvalidity and uidvalidity != str(email_data['uidvalidity'])):
             return jsonify({
                 'success': False,
                 'error': 'Email not found'
             }), 404
         
-        # Extract the actual email address from the 'to' field
-        extracted_email = extract_email_from_to_field(email_data['to'])
-        
-        # Check if the extracted email matches the hash
-        if not extracted_email or extracted_email.lower() != f'{hash}@ghostinbox.it'.lower():
+        validator = (message_etag('api', hash, email_data['uidvalidity'], int(email_id)),
+                     to_datetime(parse_date_header(email_data['date'])))
+        return with_validators(jsonify({
+            'success': True,
+            'email': email_data
+        }), validator, HTTP_MESSAGE_MAX_AGE)
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/emails/<email_id>/attachments')
+def api_list_attachments(email_id):
+    """
+    API endpoint listing the attachments of an email from its BODYSTRUCTURE.
+    Query parameters:
+    - alias: required alias to verify email ownership
+    """
+    alias = request.args.get('alias', '').strip()
+
+    if not alias or len(alias) < 8:
+        return jsonify({
+            'success': False,
+            'error': 'Alias is required to list attachments'
+        }), 400
+
+    hash = hashlib.sha256(alias.encode()).hexdigest()
+
+    try:
+        if not owns_email(email_id, hash):
             return jsonify({
                 'success': False,
                 'error': 'Email not found or hash mismatch'
             }), 403
-        
+
+        email_parts = get_email_parts(email_id, hash)
+        if not email_parts:
+            return jsonify({
+                'success': False,
+                'error': 'Email not found'
+            }), 404
+
         return jsonify({
             'success': True,
-            'email': email_data
+            'attachments': [{
+                'part': part['section'],
+                'filename': part['filename'],
+                'content_type': part['type'],
+                'size': part['size'],
+                'encoding': part['encoding']
+            } for part in list_attachments(email_parts['parts'])]
         })
-    
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/emails/<email_id>/attachments/<part>')
+def api_get_attachment(email_id, part):
+    """
+    API endpoint streaming one attachment, fetched from the mail server in chunks.
+    Query parameters:
+    - alias: required alias to verify email ownership
+
+    A Range header is honoured whenever the size of the decoded attachment is
+    known up front: for parts stored without transfer encoding, and for any
+    part when the server supports the BINARY extension.
+    """
+    alias = request.args.get('alias', '').strip()
+
+    if not alias or len(alias) < 8:
+        return jsonify({
+            'success': False,
+            'error': 'Alias is required to download attachments'
+        }), 400
+
+    hash = hashlib.sha256(alias.encode()).hexdigest()
+
+    try:
+        if not owns_email(email_id, hash):
+            return jsonify({
+                'success': False,
+                'error': 'Email not found or hash mismatch'
+            }), 403
+
+        email_parts = get_email_parts(email_id, hash)
+        if not email_parts:
+            return jsonify({
+                'success': False,
+                'error': 'Email not found'
+            }), 404
+
+        attachment = next((p for p in list_attachments(email_parts['parts']) if p['section'] == part), None)
+        if not attachment:
+            return jsonify({
+                'success': False,
+                'error': 'Attachment not found'
+            }), 404
+
+        imap_mux = backend_for(hash).imap_mux
+        uid = int(email_id)
+        section = attachment['section']
+        item = 'BODY'
+        size = None
+        if attachment['encoding'] in IDENTITY_ENCODINGS:
+            size = attachment['size']
+        else:
+            if 'BINARY' in imap_mux.capabilities:
+                item = 'BINARY'
+                size = binary_size(imap_mux, uid, section)
+
+        headers = {
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(attachment['filename'] or f'part-{section}')}"
+        }
+        status = 200
+        start, stop = 0, size
+        if size is not None:
+            headers['Accept-Ranges'] = 'bytes'
+            if request.range:
+                requested = request.range.range_for_length(size)
+                if requested is None:
+                    return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+                start, stop = requested
+                headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+                status = 206
+            headers['Content-Length'] = str(stop - start)
+
+        def generate():
+            # Each chunk is one command pipelined on the shared session
+            if size is None:
+                yield from decode_chunks(fetch_section(imap_mux, uid, section), attachment['encoding'])
+            elif stop > start:
+                yield from fetch_section(imap_mux, uid, section, offset=start, length=stop - start, item=item)
+
+        return Response(generate(), status=status, mimetype=attachment['type'], headers=headers)
+
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1,9 +1,12 @@
-from datetime import datetime
-import imaplib
 import email
-from email.header import decode_header
 import os
+import re
 from dotenv import load_dotenv
+from email_headers import decode_header_text, extract_email_from_to_field
+from imap_batch import fetch_batched, quote_mailbox, search_uids
+from mail_index import recipient_hashes
+from maintenance import RETENTION_DOMAIN, move_uids, recipient_criteria, run_sharded_maintenance
+from shards import shard_index
 
 # Load environment variables
 load_dotenv()
@@ -13,19 +16,104 @@ EMAIL_ADDRESS = os.getenv('BASE_EMAIL')
 PASSWORD = os.getenv('BASE_PASSWORD')
 IMAP_SERVER = 'imapmail.libero.it'
 
-def extract_email_from_to_field(to_field):
-    """Extract email address from the 'to' field"""
-    import re
-    if not to_field:
-        return None
-    email_pattern = r'<([^>]+)>|([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})'
-    match = re.search(email_pattern, to_field)
-    if match:
-        return match.group(1) if match.group(1) else match.group(2)
-    return None
-
-def check_and_move_spam_emails(mail):
-    """Check spam folder and move emails back to inbox"""
+# Spam folder to rescue emails from; looked up with LIST when not set
+SPAM_FOLDER = os.getenv('SPAM_FOLDER')
+
+# Names recognised as spam folders when none is flagged \\Junk
+SPAM_FOLDER_NAMES = ('spam', 'junk', 'bulk', 'spam_folder', 'junk_mail')
+
+# Headers only: spam is listed, never downloaded. The recipient headers pick
+# the shard each email is moved back to
+SPAM_REPORT_FETCH_ITEMS = '(UID BODY.PEEK[HEADER.FIELDS (FROM TO CC DELIVERED-TO X-ORIGINAL-TO SUBJECT)])'
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+LIST_PATTERN = re.compile(rb'^\((?P<flags>[^)]*)\) (?:"(?:[^"\\]|\\.)*"|NIL) (?P<name>.*)$')
+
+def find_spam_folder(mail, known=None):
+    """
+    Resolve the spam folder of an account, running LIST only when it is not known yet.
+
+    The folder flagged \\Junk is preferred, as advertised by servers with
+    SPECIAL-USE (RFC 6154); otherwise the first folder with a common spam
+    name is used. Setting SPAM_FOLDER skips the lookup entirely.
+
+    Args:
+        mail (imaplib.IMAP4): Logged-in connection
+        known (str): Folder resolved by an earlier run, as kept in the
+            maintenance checkpoint
+
+    Returns:
+        str: Folder name, or None if the account has no spam folder
+    """
+    if SPAM_FOLDER:
+        return SPAM_FOLDER
+    if known:
+        return known
+
+    status, folders = mail.list()
+    junk = named = None
+    for folder in folders if status == 'OK' else []:
+        # Names sent as literals come back as (line, name) tuples
+        line, literal = (folder[0], folder[1]) if isinstance(folder, tuple) else (folder, None)
+        match = LIST_PATTERN.match(line or b'')
+        if not match:
+            continue
+        name = literal if literal is not None else match.group('name')
+        name = name.decode('utf-8', errors='replace')
+        if name.startswith('"') and name.endswith('"'):
+            name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+        if b'\\junk' in match.group('flags').lower().split():
+            junk = name
+            break
+        if named is None and any(spam_name in name.lower() for spam_name in SPAM_FOLDER_NAMES):
+            named = name
+
+    return junk or named
+
+def rescue_folder(items, shards, account, inbox, domain=RETENTION_DOMAIN):
+    """
+    Pick the folder a rescued email belongs in: that of the shard its alias hash maps to.
+
+    Args:
+        items (dict): FETCH items with the recipient headers
+        shards (list): Every shard, as returned by shards.load_shards()
+        account (str): Account the spam folder belongs to
+        inbox (str): Fallback folder
+        domain (str): Domain of the hash addresses
+
+    Returns:
+        str: Folder of the lowest-numbered shard of the email's hashes, or
+            inbox when it has no hash address or that shard is in another
+            account (mail cannot be moved between accounts)
+    """
+    hashes = [hash for hash in recipient_hashes(items, domain) if HASH_PATTERN.match(hash)]
+    if not shards or not hashes:
+        return inbox
+    shard = shards[min(shard_index(hash, len(shards)) for hash in hashes)]
+    return shard.mailbox if shard.account == account else inbox
+
+def check_and_move_spam_emails(mail, domain=RETENTION_DOMAIN, account=EMAIL_ADDRESS, inbox='INBOX', shards=None,
+                               spam_folder=None):
+    """
+    Move the emails sent to domain out of the spam folder, back to their shard.
+
+    The server finds them with one UID SEARCH and moves them with one UID MOVE
+    (or UID COPY and UID STORE) per destination folder; only their headers
+    are fetched, for the report and to route them with rescue_folder().
+
+    Args:
+        mail (imaplib.IMAP4): Logged-in connection
+        domain (str): Domain whose emails are rescued
+        account (str): Account the spam folder belongs to
+        inbox (str): Folder of emails no shard of this account claims
+        shards (list): Every shard, None to move everything to inbox
+        spam_folder (str): Spam folder resolved by an earlier run, None to look it up
+
+    Returns:
+        str: Spam folder used, to be kept for the next run, or None if it
+            could not be opened
+    """
     # ANSI color codes
     RED = '\033[91m'
     GREEN = '\033[92m'
@@ -35,196 +123,128 @@ def check_and_move_spam_emails(mail):
     BOLD = '\033[1m'
     
     try:
-        # List all folders to find spam folder
-        status, folders = mail.list()
-        spam_folder = None
-        
-        # Common spam folder names
-        spam_names = ['spam', 'junk', 'bulk', 'spam_folder', 'junk_mail']
-        
-        for folder in folders:
-            folder_name = folder.decode().split(' ')[-1]
-            if any(spam_name in folder_name.lower() for spam_name in spam_names):
-                spam_folder = folder_name
-                break
-        
+        known = spam_folder
+        spam_folder = find_spam_folder(mail, known)
         if not spam_folder:
             print(f"{YELLOW}No spam folder found. Skipping spam check.{RESET}")
-            return
+            return None
         
         print(f"\n{BOLD}Checking spam folder: {spam_folder}{RESET}")
         print(f"{BLUE}{'-' * 80}{RESET}")
         
-        # Select spam folder
-        mail.select(spam_folder)
+        # Select spam folder, looking it up again if the known one is gone
+        status, data = mail.select(quote_mailbox(spam_folder))
+        if status != 'OK' and known and not SPAM_FOLDER:
+            spam_folder = find_spam_folder(mail)
+            if spam_folder:
+                status, data = mail.select(quote_mailbox(spam_folder))
+        if status != 'OK':
+            print(f"{YELLOW}Spam folder cannot be opened. Skipping spam check.{RESET}")
+            return None
+        spam_count = int(data[0] or 0)
         
-        # Search for all emails in spam
-        status, data = mail.search(None, 'ALL')
-        spam_email_ids = data[0].split()
+        # Only emails for the service are rescued
+        spam_email_ids = search_uids(mail, *recipient_criteria(domain))
         
         if not spam_email_ids:
-            print(f"{GREEN}No emails found in spam folder.{RESET}")
-            return
+            print(f"{GREEN}No emails for @{domain} found in spam folder.{RESET}")
+            return spam_folder
         
-        print(f"{BOLD}Found {len(spam_email_ids)} emails in spam folder:{RESET}")
+        print(f"{BOLD}Found {len(spam_email_ids)} emails for @{domain} in spam folder:{RESET}")
         print(f"{BOLD}{'From':<30} {'To':<30} {'Subject':<40}{RESET}")
         print(f"{BLUE}{'-' * 100}{RESET}")
         
-        moved_count = 0
-        
-        for email_id in spam_email_ids:
-            # Fetch email
-            status, msg_data = mail.fetch(email_id, '(RFC822)')
-            msg = email.message_from_bytes(msg_data[0][1])
+        destinations = {}
+        for email_id, items in fetch_batched(mail, spam_email_ids, SPAM_REPORT_FETCH_ITEMS, uid=True):
+            destinations.setdefault(rescue_folder(items, shards, account, inbox, domain), []).append(email_id)
+            headers = next((value for key, value in items.items() if key.startswith('BODY[HEADER')), b'')
+            msg = email.message_from_bytes(headers or b'')
             
             # Get email details
-            from_ = msg.get('from', 'Unknown')
-            to_ = msg.get('to', 'Unknown')
+            from_ = decode_header_text(msg.get('from'), 'Unknown')
+            to_ = decode_header_text(msg.get('to'), 'Unknown')
             
             # Extract email from 'to' field
             extracted_email = extract_email_from_to_field(to_)
             
             # Get subject
-            subject, encoding = decode_header(msg['subject'])[0] if msg['subject'] else ('No Subject', None)
-            if isinstance(subject, bytes):
-                subject = subject.decode(encoding or 'utf-8', errors='ignore')
+            subject = decode_header_text(msg.get('subject'), 'No Subject')
             
             # Print email info
             print(f"{from_[:30]:<30} {extracted_email[:30] if extracted_email else 'Unknown':<30} {subject[:40]:<40}")
-            
-            # Move email back to inbox
+        
+        # Emails whose headers could not be read stay with the account's first shard
+        listed = {uid for uids in destinations.values() for uid in uids}
+        destinations.setdefault(inbox, []).extend(uid for uid in spam_email_ids if uid not in listed)
+
+        # One move per destination folder
+        moved_count = 0
+        for folder, uids in destinations.items():
+            if not uids:
+                continue
             try:
-                # Copy email to inbox
-                mail.copy(email_id, 'INBOX')
-                # Mark for deletion from spam
-                mail.store(email_id, '+FLAGS', '\\Deleted')
-                moved_count += 1
-                print(f"{GREEN}  ✓ Moved to inbox{RESET}")
+                move_uids(mail, sorted(uids), folder)
+                moved_count += len(uids)
+                print(f"{GREEN}  ✓ Moved {len(uids)} emails to {folder}{RESET}")
             except Exception as e:
-                print(f"{RED}  ✗ Failed to move: {e}{RESET}")
-        
-        # Permanently remove emails from spam folder
-        mail.expunge()
+                print(f"{RED}  ✗ Failed to move to {folder}: {e}{RESET}")
         
         print(f"\n{BOLD}Spam Processing Summary:{RESET}")
         print(f"{BLUE}{'-' * 30}{RESET}")
-        print(f"{BOLD}Emails moved to inbox:{RESET} {moved_count}")
-        print(f"{BOLD}Total emails in spam:{RESET} {len(spam_email_ids)}")
+        print(f"{BOLD}Emails moved out of spam:{RESET} {moved_count}")
+        print(f"{BOLD}Total emails in spam:{RESET} {spam_count}")
         print(f"{BLUE}{'-' * 30}{RESET}")
+        return spam_folder
         
     except Exception as e:
         print(f"{RED}Error processing spam folder: {e}{RESET}")
+        return None
+
+def print_report(stats):
+    """Print the emails handled by a maintenance run and the summary statistics"""
+    # ANSI color codes
+    RED = '\033[91m'
+    GREEN = '\033[92m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+    print(f"\n{BOLD}GhostInbox Email Statistics:{RESET}")
+    print(f"{BLUE}{'-' * 135}{RESET}")
+    print(f"{BOLD}{'From':<30} {'To':<30} {'Subject':<40} {'Age (days)':<12} {'Size (bytes)':<12} {'Status':<10}{RESET}")
+    print(f"{BLUE}{'-' * 135}{RESET}")
+
+    for row in stats['processed']:
+        status_color = GREEN
+        if row['status'] == 'Deleted':
+            status_color = RED
+        elif isinstance(row['age_days'], int) and row['age_days'] > 20:
+            status_color = YELLOW
+
+        # Print formatted output with colors
+        print(f"{row['from_'][:30]:<30} {row['to_'][:30]:<30} {row['subject'][:40]:<40} "
+              f"{str(row['age_days']):<12} {row['size']:<12} {status_color}{row['status']:<10}{RESET}")
+
+    # Print summary statistics
+    print(f"\n{BOLD}Summary Statistics:{RESET}")
+    print(f"{BLUE}{'-' * 30}{RESET}")
+    print(f"{BOLD}Total GhostInbox Emails:{RESET} {stats['total_emails']}")
+    print(f"{BOLD}Non-ghostinbox emails deleted:{RESET} {stats['non_ghostinbox_deleted']}")
+    print(f"{BOLD}Unique Senders:{RESET} {stats['unique_senders']}")
+    print(f"{BOLD}Unique Receivers:{RESET} {stats['unique_receivers']}")
+    print(f"{BOLD}Deleted old emails:{RESET} {stats['deleted_count']}")
+    print(f"{BLUE}{'-' * 30}{RESET}")
 
 def get_email_stats():
     try:
-        # Connect to IMAP server
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
-        mail.login(EMAIL_ADDRESS, PASSWORD)
-        
-        # First, check and move emails from spam folder
-        check_and_move_spam_emails(mail)
-        
-        # Now process inbox
-        mail.select('inbox')
-
-        # Search for all emails
-        status, data = mail.search(None, 'ALL')
-        email_ids = data[0].split()
-
-        # ANSI color codes
-        RED = '\033[91m'
-        GREEN = '\033[92m'
-        YELLOW = '\033[93m'
-        BLUE = '\033[94m'
-        RESET = '\033[0m'
-        BOLD = '\033[1m'
-
-        # Statistics tracking
-        total_emails = 0
-        ghostinbox_emails = 0
-        unique_senders = set()
-        unique_receivers = set()
-        deleted_count = 0
-
-        print(f"\n{BOLD}GhostInbox Email Statistics:{RESET}")
-        print(f"{BLUE}{'-' * 135}{RESET}")
-        print(f"{BOLD}{'From':<30} {'To':<30} {'Subject':<40} {'Age (days)':<12} {'Size (bytes)':<12} {'Status':<10}{RESET}")
-        print(f"{BLUE}{'-' * 135}{RESET}")
-
-        for email_id in email_ids:
-            # Fetch email
-            status, msg_data = mail.fetch(email_id, '(RFC822)')
-            msg = email.message_from_bytes(msg_data[0][1])
-
-            # Get email details
-            from_ = msg.get('from', 'Unknown')
-            to_ = msg.get('to', 'Unknown')
-            
-            # Extract email from 'to' field and check if it's ghostinbox.it
-            extracted_email = extract_email_from_to_field(to_)
-            if not extracted_email or not extracted_email.lower().endswith('@ghostinbox.it'):
-                # Delete emails that don't end with @ghostinbox.it
-                mail.store(email_id, '+FLAGS', '\\Deleted')
-                print(f"{RED}🗑️  Deleting non-ghostinbox email: {extracted_email or 'unknown'}{RESET}")
-                continue  # Skip processing but mark for deletion
-            
-            ghostinbox_emails += 1
-            total_emails += 1
-            
-            # Update unique senders and receivers
-            unique_senders.add(from_)
-            unique_receivers.add(extracted_email)
-            
-            # Get subject
-            subject, encoding = decode_header(msg['subject'])[0] if msg['subject'] else ('No Subject', None)
-            if isinstance(subject, bytes):
-                subject = subject.decode(encoding or 'utf-8', errors='ignore')
-
-            # Calculate age in days
-            date_str = msg.get('date')
-            age_days = 'N/A'
-            if date_str:
-                try:
-                    email_date = datetime.strptime(date_str, '%a, %d %b %Y %H:%M:%S %z')
-                    age_days = (datetime.now(email_date.tzinfo) - email_date).days
-                except ValueError:
-                    print(f"Error parsing date: {date_str}")
-
-            # Calculate size
-            size = len(msg_data[0][1])
-
-            # Check if email should be deleted
-            status = 'Kept'
-            status_color = GREEN
-            if isinstance(age_days, int):
-                if age_days > 30:
-                    mail.store(email_id, '+FLAGS', '\\Deleted')
-                    status = 'Deleted'
-                    status_color = RED
-                    deleted_count += 1
-                elif age_days > 20:
-                    status_color = YELLOW
-
-            # Print formatted output with colors
-            print(f"{from_[:30]:<30} {extracted_email[:30]:<30} {subject[:40]:<40} "
-                  f"{str(age_days):<12} {size:<12} {status_color}{status:<10}{RESET}")
-
-        # Print summary statistics
-        print(f"\n{BOLD}Summary Statistics:{RESET}")
-        print(f"{BLUE}{'-' * 30}{RESET}")
-        print(f"{BOLD}Total GhostInbox Emails:{RESET} {ghostinbox_emails}")
-        print(f"{BOLD}Non-ghostinbox emails deleted:{RESET} {len(email_ids) - ghostinbox_emails}")
-        print(f"{BOLD}Unique Senders:{RESET} {len(unique_senders)}")
-        print(f"{BOLD}Unique Receivers:{RESET} {len(unique_receivers)}")
-        print(f"{BOLD}Deleted old emails:{RESET} {deleted_count}")
-        print(f"{BLUE}{'-' * 30}{RESET}")
+        # Rescue spam, then process every shard at once
+        stats = run_sharded_maintenance(rescue_spam=True)
 
-        # Permanently remove deleted emails
-        mail.expunge()
-        mail.logout()
+        print_report(stats)
 
     except Exception as e:
-        print(f"{RED}Error: {e}{RESET}")
+        print(f"\033[91mError: {e}\033[0m")
 
 if __name__ == '__main__':
-    get_email_stats() 
\ No newline at end of file
+    get_email_stats()
\ No newline at end of file
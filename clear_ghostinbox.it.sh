@@ -1,6 +1,5 @@
 #!/bin/sh
 
 . venv/bin/activate
-python stats.py
-python cleanup.py
+python maintenance.py
 deactivate
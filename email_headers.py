@@ -0,0 +1,177 @@
+import re
+import timeit
+from functools import lru_cache
+from email.header import decode_header
+from email.utils import getaddresses, mktime_tz, parsedate_tz
+
+# Last resort for headers getaddresses() cannot make sense of
+ADDRESS_PATTERN = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+
+# Distinct header values whose parsed addresses are kept; the same To and
+# From values come back over and over in an inbox of aliases
+ADDRESS_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _parse_addresses(field):
+    addresses = []
+    for _, address in getaddresses([field]):
+        address = address.strip().lower()
+        if '@' in address and address not in addresses:
+            addresses.append(address)
+    if not addresses:
+        for address in ADDRESS_PATTERN.findall(field):
+            address = address.lower()
+            if address not in addresses:
+                addresses.append(address)
+    return tuple(addresses)
+
+
+def extract_addresses(*fields):
+    """
+    Extract every email address from one or more address headers.
+
+    Handles plain addresses, display names (quoted or not, with commas) and
+    lists, e.g. '"Surname, Name" <user@example.com>, other@example.com'.
+
+    Args:
+        *fields (str): Header values such as To, Cc or From, None is ignored
+
+    Returns:
+        list: Lowercased addresses in header order, without duplicates
+    """
+    addresses = []
+    for field in fields:
+        if not field:
+            continue
+        for address in _parse_addresses(str(field)):
+            if address not in addresses:
+                addresses.append(address)
+    return addresses
+
+
+def extract_email_from_to_field(to_field):
+    """
+    Extract the first email address from an address header.
+
+    Args:
+        to_field (str): The 'to' (or 'from') field content
+
+    Returns:
+        str: The lowercased address or None if not found
+    """
+    addresses = extract_addresses(to_field)
+    return addresses[0] if addresses else None
+
+
+def decode_header_text(value, default=None):
+    """
+    Decode a header to text, encoded-words included.
+
+    With the compat32 policy a header holding raw 8-bit bytes comes back as
+    an email.header.Header whose charset is "unknown-8bit"; chunks in a
+    charset Python does not know are decoded as UTF-8, replacing what is not.
+
+    Args:
+        value (str or Header): Header as returned by Message.get()
+        default (str): Returned when the header is missing
+
+    Returns:
+        str: Decoded header, or default
+    """
+    if value is None:
+        return default
+    text = []
+    for chunk, charset in decode_header(value):
+        if isinstance(chunk, bytes):
+            try:
+                chunk = chunk.decode(charset or 'ascii')
+            except (LookupError, UnicodeDecodeError):
+                chunk = chunk.decode('utf-8', errors='replace')
+        text.append(chunk)
+    return ''.join(text)
+
+
+def parse_date_header(value):
+    """
+    Convert a Date header to a UNIX timestamp.
+
+    Tolerates the variants strptime() rejects: a missing weekday, comments
+    such as "(UTC)", two-digit years, named zones and a missing offset
+    (taken as UTC).
+
+    Args:
+        value (str): The 'date' field content
+
+    Returns:
+        float: Seconds since the epoch, None if the header is missing or unparseable
+    """
+    if not value:
+        return None
+    parsed = parsedate_tz(str(value))
+    if not parsed:
+        return None
+    try:
+        return float(mktime_tz(parsed))
+    except (OverflowError, ValueError):
+        return None
+
+
+# Samples of To headers as they show up in the inbox
+BENCHMARK_HEADERS = [
+    'user@example.com',
+    '<user@example.com>',
+    'Mario Rossi <mario.rossi@libero.it>',
+    '"Rossi, Mario" <Mario.Rossi@Libero.IT>',
+    '"Newsletter" <news+promo@mailer.example.co.uk>, undisclosed-recipients:;',
+    '=?UTF-8?B?SsO8cmdlbg==?= <juergen@example.de>',
+    '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08@ghostinbox.it',
+    '"Ghost" <9F86D081884C7D659A2FEAA0C55AD015A3BF4F1B2B0B822CD15D6C15B0F00A08@ghostinbox.it>',
+    'a@example.com, "B, C" <b.c@example.com>, d@example.org',
+    'Undisclosed recipients:;',
+    'broken <address@example.com',
+]
+
+
+def _regex_per_call(to_field):
+    """The previous per-module implementation, kept for the benchmark"""
+    if not to_field:
+        return None
+    email_pattern = r'<([^>]+)>|([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})'
+    match = re.search(email_pattern, to_field)
+    if match:
+        return match.group(1) if match.group(1) else match.group(2)
+    return None
+
+
+def benchmark(headers=BENCHMARK_HEADERS, rounds=2000):
+    """
+    Time address extraction per call over a corpus of To headers.
+
+    Args:
+        headers (list): Header values to parse
+        rounds (int): Passes over the corpus
+
+    Returns:
+        dict: Microseconds per call of the old regex, getaddresses without and with the cache
+    """
+    calls = len(headers) * rounds
+
+    def per_call(function):
+        return round(timeit.timeit(lambda: [function(h) for h in headers], number=rounds) / calls * 1e6, 3)
+
+    def uncached(header):
+        _parse_addresses.cache_clear()
+        return extract_addresses(header)
+
+    return {
+        'regex_first_address_us': per_call(_regex_per_call),
+        'getaddresses_uncached_us': per_call(uncached),
+        'getaddresses_cached_us': per_call(extract_addresses)
+    }
+
+
+if __name__ == '__main__':
+    for header in BENCHMARK_HEADERS:
+        print(f"{header[:60]:<60} -> {extract_addresses(header)}")
+    print(f"⏱️ {benchmark()}")
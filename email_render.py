@@ -0,0 +1,230 @@
+import hashlib
+import html
+import re
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+# Bumped whenever the sanitizer output changes, so cached renderings are redone
+RENDER_VERSION = 4
+
+# Tags kept, with their attributes; everything else is unwrapped to its text
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'big', 'blockquote', 'br', 'caption', 'center', 'code', 'col', 'colgroup',
+    'dd', 'div', 'dl', 'dt', 'em', 'font', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img',
+    'li', 'ol', 'p', 'pre', 's', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'table',
+    'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul'
+}
+VOID_TAGS = {'br', 'col', 'hr', 'img'}
+
+# Tags dropped together with everything inside them
+DROPPED_TAGS = {
+    'applet', 'audio', 'form', 'frameset', 'head', 'iframe', 'math', 'noscript', 'object', 'script',
+    'select', 'style', 'svg', 'template', 'textarea', 'title', 'video'
+}
+
+# Void elements that are dropped: no end tag ever comes, so nothing is skipped after them
+DROPPED_VOID_TAGS = {'embed', 'frame', 'param', 'source', 'track'}
+
+ALLOWED_ATTRIBUTES = {
+    'align', 'alt', 'bgcolor', 'border', 'cellpadding', 'cellspacing', 'color', 'colspan', 'dir', 'face',
+    'height', 'href', 'rowspan', 'size', 'src', 'style', 'title', 'valign', 'width'
+}
+
+LINK_SCHEMES = {'http', 'https', 'mailto'}
+
+# Inline style properties kept. Positioning, stacking and transforms are left
+# out: they let an email escape its box and cover the page around it
+STYLE_PROPERTIES = {
+    'background', 'background-color', 'border', 'border-bottom', 'border-collapse', 'border-color',
+    'border-left', 'border-radius', 'border-right', 'border-spacing', 'border-style', 'border-top',
+    'border-width', 'color', 'direction', 'display', 'float', 'font', 'font-family', 'font-size',
+    'font-style', 'font-variant', 'font-weight', 'height', 'letter-spacing', 'line-height',
+    'list-style-type', 'margin', 'margin-bottom', 'margin-left', 'margin-right', 'margin-top',
+    'max-height', 'max-width', 'min-height', 'min-width', 'overflow', 'padding', 'padding-bottom',
+    'padding-left', 'padding-right', 'padding-top', 'table-layout', 'text-align', 'text-decoration',
+    'text-indent', 'text-transform', 'vertical-align', 'white-space', 'width', 'word-break',
+    'word-spacing'
+}
+
+# Declarations that load a remote resource (counted as blocked), including the
+# image functions taking a bare string URL, e.g. image-set('https://...' 1x)
+REMOTE_STYLE = re.compile(r'(url|src|image-set|image|cross-fade|element)\s*\(', re.IGNORECASE)
+
+# Declarations able to run script, or hiding something behind CSS escapes
+UNSAFE_STYLE = re.compile(r'expression\s*\(|@import|javascript:|behavior\s*:|-moz-binding|\\', re.IGNORECASE)
+
+# A negative length, which pulls a margin outside the email's box
+NEGATIVE_LENGTH = re.compile(r'(^|[\s(,*/])-\s*[\d.]')
+
+# Inline images that can be shown without any request
+INLINE_IMAGE = re.compile(r'data:image/(png|gif|jpe?g|webp);base64,', re.IGNORECASE)
+
+
+class _Sanitizer(HTMLParser):
+    """Re-serializes an HTML body keeping only allowlisted tags and attributes"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.open_tags = []
+        self.dropping = []
+        self.blocked = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body' and self.dropping == ['head']:
+            # An unclosed head ends where the body starts
+            self.dropping.pop()
+        if tag in DROPPED_VOID_TAGS:
+            return
+        if tag in DROPPED_TAGS:
+            self.dropping.append(tag)
+            return
+        if self.dropping:
+            return
+        if tag not in ALLOWED_TAGS:
+            return
+        self.out.append(f'<{tag}{self._attributes(tag, attrs)}>')
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if self.dropping:
+            if tag in self.dropping:
+                while self.dropping.pop() != tag:
+                    pass
+            return
+        if tag not in self.open_tags:
+            return
+        # Close whatever the sender left open inside tag
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.out.append(f'</{open_tag}>')
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.out.append(html.escape(data, quote=False))
+
+    def _attributes(self, tag, attrs):
+        kept = []
+        for name, value in attrs:
+            value = (value or '').strip()
+            if name not in ALLOWED_ATTRIBUTES:
+                continue
+            if name == 'href':
+                if tag != 'a' or not self._is_link(value):
+                    continue
+            elif name == 'src':
+                if tag != 'img':
+                    continue
+                if not INLINE_IMAGE.match(value):
+                    # Remote images are trackers as often as content
+                    self.blocked += 1
+                    kept.append(('data-blocked-src', value))
+                    continue
+            elif name == 'style':
+                value = self._style(value)
+                if not value:
+                    continue
+            kept.append((name, value))
+        if tag == 'a' and any(name == 'href' for name, _ in kept):
+            kept += [('target', '_blank'), ('rel', 'noopener noreferrer nofollow')]
+        return ''.join(f' {name}="{html.escape(value)}"' for name, value in kept)
+
+    def _style(self, style):
+        """Keep the declarations of an inline style whose property is allowlisted and value harmless"""
+        kept = []
+        loads = False
+        for declaration in style.split(';'):
+            name, _, value = declaration.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if not value:
+                continue
+            if REMOTE_STYLE.search(declaration):
+                loads = True
+                continue
+            if UNSAFE_STYLE.search(declaration):
+                continue
+            if name not in STYLE_PROPERTIES:
+                continue
+            if name.startswith('margin') and NEGATIVE_LENGTH.search(value):
+                continue
+            kept.append(f'{name}: {value}')
+        if loads:
+            self.blocked += 1
+        return '; '.join(kept)
+
+    @staticmethod
+    def _is_link(url):
+        # Browsers ignore whitespace and control characters inside schemes
+        scheme = urlsplit(re.sub(r'[\x00-\x20]', '', url)).scheme.lower()
+        return scheme in LINK_SCHEMES
+
+    def result(self):
+        self.close()
+        return ''.join(self.out + [f'</{tag}>' for tag in reversed(self.open_tags)])
+
+
+def sanitize_html(body):
+    """
+    Make an HTML email body safe to embed in a page.
+
+    Keeps an allowlist of formatting tags and attributes. Scripts, styles,
+    frames, forms and embedded objects are removed with their content, event
+    handlers and non-http(s)/mailto links are dropped, and links open in a new
+    tab without a referrer. Inline styles keep only STYLE_PROPERTIES, without
+    negative margins, so the email cannot be laid over the page. Remote images
+    are not loaded: their URL moves to data-blocked-src.
+
+    Args:
+        body (str): HTML body as decoded from the email
+
+    Returns:
+        tuple: (sanitized HTML, number of remote resources blocked)
+    """
+    sanitizer = _Sanitizer()
+    sanitizer.feed(body)
+    return sanitizer.result(), sanitizer.blocked
+
+
+def render_key(body, content_type, truncated):
+    """Content address of a rendering: the same input always renders to the same output"""
+    digest = hashlib.sha256(f'{RENDER_VERSION}\0{content_type}\0{int(bool(truncated))}\0'.encode())
+    digest.update(body.encode('utf-8', errors='surrogatepass'))
+    return digest.hexdigest()
+
+
+def render_body(body, content_type, truncated=False):
+    """
+    Turn the decoded text part of an email into the HTML shown to the user.
+
+    HTML parts are sanitized, plain text is escaped, so templates can insert
+    the result as is.
+
+    Args:
+        body (str): Decoded text part
+        content_type (str): 'text/html' or 'text/plain'
+        truncated (bool): Whether the body was cut at MAX_BODY_SIZE
+
+    Returns:
+        dict: 'body', 'html', 'content_type', 'truncated', 'remote_resources_blocked'
+            and 'digest', the content address of the rendering
+    """
+    if content_type == 'text/html':
+        rendered, blocked = sanitize_html(body)
+    else:
+        rendered, blocked = html.escape(body, quote=False), 0
+    return {
+        'body': body,
+        'html': rendered,
+        'content_type': content_type,
+        'truncated': truncated,
+        'remote_resources_blocked': blocked,
+        'digest': render_key(body, content_type, truncated)
+    }
+
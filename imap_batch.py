@@ -0,0 +1,242 @@
+import os
+import re
+
+# Number of messages requested per FETCH command
+FETCH_CHUNK_SIZE = int(os.getenv('IMAP_FETCH_CHUNK_SIZE', 50))
+
+# Literal marker ending a line; ~{n} is a literal8 (RFC 3516), which may hold NUL bytes
+LITERAL_PATTERN = re.compile(rb'~?\{(\d+)\}$')
+
+
+def to_sequence_set(ids):
+    """
+    Collapse message numbers into an IMAP sequence set.
+
+    Args:
+        ids (iterable): Message numbers as int, str or bytes
+
+    Returns:
+        str: Sequence set such as "1:50,52,60:80"
+    """
+    numbers = sorted({int(i) for i in ids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+def quote_mailbox(name):
+    """
+    Quote a mailbox name for use as a command argument.
+
+    imaplib sends arguments as given, so a folder such as "Spam Mail" must be
+    quoted or the server sees two arguments. Names already quoted are kept.
+    """
+    name = str(name)
+    if len(name) >= 2 and name.startswith('"') and name.endswith('"'):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def chunked(ids, size):
+    """Split a list of message numbers into lists of at most size items"""
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _tokenize(data):
+    """
+    Turn the raw data returned by imaplib's fetch into a flat token list.
+
+    imaplib hands back plain bytes for text and (text, literal) tuples where the
+    text ends with a {n} (or literal8 ~{n}) marker; literals become single bytes
+    tokens.
+    """
+    tokens = []
+    for element in data:
+        if isinstance(element, tuple):
+            text, literal = element
+            marker = LITERAL_PATTERN.search(text)
+            if marker:
+                text = text[:marker.start()]
+            _tokenize_text(text, tokens)
+            tokens.append(bytes(literal))
+        elif element is not None:
+            _tokenize_text(element, tokens)
+    return tokens
+
+
+def _tokenize_text(text, tokens):
+    i = 0
+    length = len(text)
+    while i < length:
+        char = text[i:i + 1]
+        if char in (b' ', b'\r', b'\n'):
+            i += 1
+        elif char in (b'(', b')'):
+            tokens.append(char.decode())
+            i += 1
+        elif char == b'"':
+            j = i + 1
+            value = bytearray()
+            while j < length and text[j:j + 1] != b'"':
+                if text[j:j + 1] == b'\\':
+                    j += 1
+                value += text[j:j + 1]
+                j += 1
+            tokens.append(bytes(value))
+            i = j + 1
+        else:
+            # Atom; brackets may contain spaces and parentheses (BODY[HEADER.FIELDS (TO)])
+            j = i
+            depth = 0
+            while j < length:
+                c = text[j:j + 1]
+                if c == b'[':
+                    depth += 1
+                elif c == b']':
+                    depth -= 1
+                elif depth == 0 and c in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                j += 1
+            atom = text[i:j]
+            tokens.append(None if atom.upper() == b'NIL' else Atom(atom))
+            i = j
+
+
+class Atom(bytes):
+    """Unquoted IMAP atom, kept distinct from strings and literals"""
+
+
+def _parse_list(tokens, pos):
+    """Parse a parenthesized list starting after its opening paren"""
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token == '(':
+            value, pos = _parse_list(tokens, pos + 1)
+            items.append(value)
+        elif token == ')':
+            return items, pos + 1
+        else:
+            items.append(token)
+            pos += 1
+    return items, pos
+
+
+def parse_fetch_response(data):
+    """
+    Parse the data list returned by imaplib's fetch into per-message dicts.
+
+    Args:
+        data (list): Second element of the (status, data) fetch result
+
+    Yields:
+        tuple: (message number, dict of upper-cased item name -> value), where
+            values are bytes, nested lists for parenthesized data or None for NIL
+    """
+    tokens = _tokenize(data)
+    pos = 0
+    while pos < len(tokens):
+        number = tokens[pos]
+        if not isinstance(number, Atom) or not number.isdigit() or pos + 1 >= len(tokens) or tokens[pos + 1] != '(':
+            pos += 1
+            continue
+        values, pos = _parse_list(tokens, pos + 2)
+        items = {}
+        for k in range(0, len(values) - 1, 2):
+            key = values[k]
+            if isinstance(key, bytes):
+                items[key.decode().upper()] = values[k + 1]
+        yield int(number), items
+
+
+def merge_uid_items(responses, uids):
+    """
+    Key parsed UID FETCH responses by UID, for the requested UIDs only.
+
+    Servers may send unsolicited FETCH responses (e.g. flag updates) for other
+    messages, or a second response for a requested one; the former are
+    dropped and the items of the latter merged into the first.
+
+    Args:
+        responses (iterable): (message number, items) pairs from parse_fetch_response()
+        uids (iterable): UIDs the FETCH asked for
+
+    Returns:
+        list: (UID, dict of fetched items) pairs in the order they first arrived
+    """
+    wanted = {int(uid) for uid in uids}
+    merged = {}
+    for _, items in responses:
+        if items.get('UID') is None:
+            continue
+        number = int(items['UID'])
+        if number not in wanted:
+            continue
+        if number in merged:
+            merged[number].update(items)
+        else:
+            merged[number] = dict(items)
+    return list(merged.items())
+
+
+def fetch_batched(mail, ids, message_parts, chunk_size=None, uid=False):
+    """
+    Fetch many messages with one FETCH command per chunk of ids.
+
+    Each chunk is sent as a single sequence set, so N messages cost about
+    N / chunk_size round trips instead of N. Results are yielded as soon as
+    each chunk has been parsed.
+
+    Args:
+        mail (imaplib.IMAP4): Connection with a mailbox selected
+        ids (list): Message numbers (or UIDs when uid is True) to fetch
+        message_parts (str): FETCH items, e.g. "(RFC822.SIZE FLAGS)"
+        chunk_size (int): Messages per FETCH command
+        uid (bool): Use UID FETCH and key the results by UID
+
+    Yields:
+        tuple: (message number or UID, dict of fetched items)
+    """
+    for chunk in chunked(ids, chunk_size or FETCH_CHUNK_SIZE):
+        if uid:
+            status, data = mail.uid('FETCH', to_sequence_set(chunk), message_parts)
+        else:
+            status, data = mail.fetch(to_sequence_set(chunk), message_parts)
+        if status != 'OK':
+            raise mail.error(f'FETCH failed: {data}')
+        if uid:
+            yield from merge_uid_items(parse_fetch_response(data), chunk)
+        else:
+            yield from parse_fetch_response(data)
+
+
+def store_batched(mail, ids, command, flags, chunk_size=None, uid=False):
+    """Apply a STORE to many messages with one command per chunk of ids"""
+    for chunk in chunked(ids, chunk_size or FETCH_CHUNK_SIZE * 10):
+        if uid:
+            mail.uid('STORE', to_sequence_set(chunk), command, flags)
+        else:
+            mail.store(to_sequence_set(chunk), command, flags)
+
+
+def search_uids(mail, *criteria):
+    """
+    Run UID SEARCH and return the matching UIDs.
+
+    Args:
+        mail (imaplib.IMAP4): Connection with a mailbox selected
+        *criteria (str): Search keys, e.g. "TO", "hash@ghostinbox.it"
+
+    Returns:
+        list: Matching UIDs as ints, ascending
+    """
+    status, data = mail.uid('SEARCH', *criteria)
+    if status != 'OK':
+        raise mail.error(f'UID SEARCH failed: {data}')
+    return sorted(int(uid) for uid in (data[0] or b'').split())
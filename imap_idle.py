@@ -0,0 +1,157 @@
+import re
+import socket
+import ssl
+import threading
+import time
+
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes
+IDLE_TIMEOUT = 25 * 60
+
+UNTAGGED_EVENT_PATTERN = re.compile(rb'^\* (\d+) (EXISTS|EXPUNGE)', re.IGNORECASE)
+
+
+class IdleWatcher(threading.Thread):
+    """
+    Background thread that waits for mailbox changes on a dedicated IMAP session.
+
+    Uses IMAP IDLE when the server advertises it and falls back to polling with
+    NOOP otherwise. Every time the server reports EXISTS or EXPUNGE, on_change
+    is called with the list of (event, number) pairs, e.g. [('EXISTS', 42)].
+
+    Args:
+        pool (IMAPConnectionPool): Pool whose settings are used to open the session
+        on_change (callable): Called with the events from the watcher thread
+        poll_interval (float): Seconds between NOOPs when IDLE is not supported
+        idle_timeout (float): Seconds before an IDLE command is renewed
+    """
+
+    def __init__(self, pool, on_change, poll_interval=15, idle_timeout=IDLE_TIMEOUT):
+        super().__init__(name='imap-idle', daemon=True)
+        self.pool = pool
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            mail = None
+            try:
+                mail = self.pool.open_connection()
+                # Anything that arrived while we were disconnected
+                self.on_change([('RECONNECT', 0)])
+                if 'IDLE' in mail.capabilities:
+                    self._watch_idle(mail)
+                else:
+                    self._watch_noop(mail)
+            except Exception as e:
+                print(f"IDLE watcher error: {e}")
+                self._stop_event.wait(self.poll_interval)
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _watch_noop(self, mail):
+        while not self._stop_event.wait(self.poll_interval):
+            mail.noop()
+            events = []
+            for name in ('EXPUNGE', 'EXISTS'):
+                typ, data = mail.response(name)
+                events.extend((name, int(number)) for number in data if number)
+            if events:
+                self.on_change(events)
+
+    def _watch_idle(self, mail):
+        while not self._stop_event.is_set():
+            events = self._idle(mail, self.idle_timeout)
+            if events:
+                self.on_change(events)
+
+    def _idle(self, mail, timeout):
+        """
+        Run one IDLE command until the server reports changes or timeout expires.
+
+        imaplib (before Python 3.14) has no IDLE support, so the command is sent
+        by hand. The continuation is read with imaplib's buffered reader, which
+        may already hold the untagged responses sent right after it: those are
+        taken from its buffer before the socket is read directly, with a short
+        timeout so the stop flag and the deadline are checked.
+        """
+        tag = mail._new_tag()
+        try:
+            mail.send(tag + b' IDLE\r\n')
+            line = mail.readline()
+            if not line.startswith(b'+'):
+                raise mail.error(f'IDLE rejected: {line!r}')
+
+            sock = mail.sock
+            previous_timeout = sock.gettimeout()
+            events = []
+            deadline = time.monotonic() + timeout
+            try:
+                buffer = self._buffered(mail)
+                sock.settimeout(1.0)
+                while True:
+                    lines = buffer.split(b'\r\n')
+                    buffer = lines.pop()
+                    for line in lines:
+                        if line.upper().startswith(b'* BYE'):
+                            raise mail.abort(line.decode(errors='ignore'))
+                        self._parse_event(line, events)
+                    if events or self._stop_event.is_set() or time.monotonic() >= deadline:
+                        break
+                    try:
+                        chunk = sock.recv(4096)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        raise mail.abort('connection closed during IDLE')
+                    buffer += chunk
+
+                mail.send(b'DONE\r\n')
+                # Read up to and including the tagged completion of IDLE
+                sock.settimeout(30)
+                while True:
+                    lines = buffer.split(b'\r\n')
+                    buffer = lines.pop()
+                    for index, line in enumerate(lines):
+                        if line.startswith(tag + b' '):
+                            if not line[len(tag) + 1:].upper().startswith(b'OK'):
+                                raise mail.error(f'IDLE failed: {line!r}')
+                            # Responses sent after the completion are reported too
+                            for later in lines[index + 1:]:
+                                self._parse_event(later, events)
+                            return events
+                        self._parse_event(line, events)
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        raise mail.abort('connection closed during IDLE')
+                    buffer += chunk
+            except socket.timeout:
+                raise mail.abort('timed out waiting for IDLE completion')
+            finally:
+                sock.settimeout(previous_timeout)
+        finally:
+            # _new_tag() registers the tag, but only imaplib's own commands clear it
+            mail.tagged_commands.pop(tag, None)
+
+    @staticmethod
+    def _buffered(mail):
+        """Take whatever imaplib's reader holds past the last line it returned, without blocking"""
+        mail.sock.settimeout(0)
+        try:
+            return mail.file.read1(65536)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return b''
+
+    @staticmethod
+    def _parse_event(line, events):
+        match = UNTAGGED_EVENT_PATTERN.match(line)
+        if match:
+            events.append((match.group(2).decode().upper(), int(match.group(1))))
@@ -0,0 +1,268 @@
+import binascii
+import os
+from email.header import decode_header, make_header
+from email.parser import BytesFeedParser
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+from imap_batch import merge_uid_items, parse_fetch_response
+
+# Bytes requested per partial FETCH when reading a MIME section
+SECTION_CHUNK_SIZE = int(os.getenv('IMAP_SECTION_CHUNK_SIZE', 256 * 1024))
+
+# Transfer encodings whose bytes on the wire are the content itself
+IDENTITY_ENCODINGS = ('7bit', '8bit', 'binary')
+
+
+def _text(value):
+    """Decode an IMAP string or atom, None for NIL"""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def _params(values):
+    """Turn a (key value key value ...) list into a dict with lower-case keys"""
+    params = {}
+    if not isinstance(values, list):
+        return params
+    for k in range(0, len(values) - 1, 2):
+        key = _text(values[k]).lower()
+        value = _text(values[k + 1]) or ''
+        if key.endswith('*'):
+            # RFC 2231, e.g. filename*=utf-8''r%C3%A9sum%C3%A9.pdf
+            key = key[:-1]
+            value = collapse_rfc2231_value(decode_rfc2231(value))
+        params[key] = value
+    return params
+
+
+def _decode_filename(name):
+    if not name:
+        return None
+    try:
+        return str(make_header(decode_header(name)))
+    except Exception:
+        return name
+
+
+def parse_bodystructure(structure, section=''):
+    """
+    Flatten a parsed BODYSTRUCTURE into the list of its leaf parts.
+
+    Encapsulated messages (message/rfc822) are kept as single parts rather
+    than descended into.
+
+    Args:
+        structure (list): BODYSTRUCTURE value as parsed by imap_batch.parse_fetch_response
+        section (str): Section number of structure, empty for the whole message
+
+    Returns:
+        list: Dicts with section, type, params, encoding, size, disposition and filename
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+
+    if isinstance(structure[0], list):
+        # Multipart: the child bodies come first, then the subtype
+        parts = []
+        number = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            parts.extend(parse_bodystructure(child, f'{section}.{number}' if section else str(number)))
+        return parts
+
+    content_type = f'{_text(structure[0])}/{_text(structure[1])}'.lower()
+    params = _params(structure[2])
+    # Extension data follows the lines count of text parts and the
+    # envelope, body and lines count of encapsulated messages
+    extension = 7
+    if content_type.startswith('text/'):
+        extension = 8
+    elif content_type == 'message/rfc822':
+        extension = 10
+    disposition = structure[extension + 1] if len(structure) > extension + 1 else None
+    disposition_type = None
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _text(disposition[0]).lower()
+        disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+
+    return [{
+        # A single-part message still has its body in section 1
+        'section': section or '1',
+        'type': content_type,
+        'params': params,
+        'encoding': (_text(structure[5]) or '7bit').lower(),
+        'size': int(structure[6]) if structure[6] is not None else 0,
+        'disposition': disposition_type,
+        'filename': _decode_filename(disposition_params.get('filename') or params.get('name'))
+    }]
+
+
+def find_text_part(parts):
+    """
+    Pick the part to display: the first inline text/plain, else the first text/html.
+
+    Args:
+        parts (list): Parts as returned by parse_bodystructure()
+
+    Returns:
+        dict: The chosen part, or None when the message has no text body
+    """
+    candidates = [part for part in parts if part['disposition'] != 'attachment' and not part['filename']]
+    for content_type in ('text/plain', 'text/html'):
+        for part in candidates:
+            if part['type'] == content_type:
+                return part
+    return None
+
+
+def list_attachments(parts):
+    """
+    Select the parts offered as attachments: anything named, marked as an
+    attachment, or not text.
+
+    Args:
+        parts (list): Parts as returned by parse_bodystructure()
+
+    Returns:
+        list: The matching parts, in message order
+    """
+    return [part for part in parts
+            if part['disposition'] == 'attachment' or part['filename'] or not part['type'].startswith('text/')]
+
+
+def fetch_section(mail, uid, section, offset=0, length=None, chunk_size=None, item='BODY'):
+    """
+    Read one MIME section with partial fetches, one chunk at a time.
+
+    Only chunk_size bytes of the section are held in memory at once, so large
+    parts can be passed on without buffering them. With item set to BINARY
+    (RFC 3516) the server decodes the section and offsets count decoded bytes.
+
+    Args:
+        mail (imaplib.IMAP4): Connection with the mailbox selected
+        uid (int): Message UID
+        section (str): Section number, e.g. "2.1"
+        offset (int): First byte of the section to read
+        length (int): Maximum number of bytes to read, None for the rest of the section
+        chunk_size (int): Bytes requested per FETCH command
+        item (str): BODY for the section as stored, BINARY for it decoded
+
+    Yields:
+        bytes: Consecutive chunks of the section
+    """
+    chunk_size = chunk_size or SECTION_CHUNK_SIZE
+    position = offset
+    end = offset + length if length is not None else None
+    while end is None or position < end:
+        size = chunk_size if end is None else min(chunk_size, end - position)
+        status, data = mail.uid('FETCH', str(uid), f'({item}.PEEK[{section}]<{position}.{size}>)')
+        if status != 'OK':
+            raise mail.error(f'FETCH failed: {data}')
+        chunk = b''
+        for _, items in merge_uid_items(parse_fetch_response(data), [uid]):
+            for key, value in items.items():
+                if key.startswith(f'{item}[') and value:
+                    chunk = bytes(value)
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            break
+        position += len(chunk)
+
+
+def binary_size(mail, uid, section):
+    """
+    Ask a server with the BINARY extension for the decoded size of a section.
+
+    Returns:
+        int: Size in bytes, None if the server did not report it
+    """
+    status, data = mail.uid('FETCH', str(uid), f'(BINARY.SIZE[{section}])')
+    if status != 'OK':
+        raise mail.error(f'FETCH failed: {data}')
+    for _, items in merge_uid_items(parse_fetch_response(data), [uid]):
+        for key, value in items.items():
+            if key.startswith('BINARY.SIZE[') and value is not None:
+                return int(value)
+    return None
+
+
+def decode_chunks(chunks, encoding):
+    """
+    Undo a transfer encoding on a stream of chunks without joining them.
+
+    Args:
+        chunks (iterable): Consecutive chunks of an encoded section
+        encoding (str): Content-Transfer-Encoding of the section
+
+    Yields:
+        bytes: Decoded data, roughly one piece per input chunk
+    """
+    if encoding not in ('base64', 'quoted-printable'):
+        yield from chunks
+        return
+
+    pending = b''
+    for chunk in chunks:
+        if encoding == 'base64':
+            # Decode whole 4-character groups, keep the rest for the next chunk
+            pending += b''.join(chunk.split())
+            cut = len(pending) - len(pending) % 4
+            data, pending = pending[:cut], pending[cut:]
+            if data:
+                yield binascii.a2b_base64(data)
+        else:
+            # Decode whole lines so soft line breaks and escapes are never split
+            lines, separator, pending = (pending + chunk).rpartition(b'\n')
+            if separator:
+                yield binascii.a2b_qp(lines + separator)
+    if pending and encoding == 'base64':
+        yield binascii.a2b_base64(pending + b'=' * (-len(pending) % 4))
+    elif pending:
+        yield binascii.a2b_qp(pending)
+
+
+def decode_text_part(part, chunks, max_size):
+    """
+    Decode the chunks of a text part read with at most max_size bytes.
+
+    The chunks are fed into a BytesFeedParser behind a synthetic header
+    carrying the part's type and transfer encoding, so the full message is
+    never needed and the part never exceeds max_size.
+
+    Args:
+        part (dict): Part as returned by find_text_part()
+        chunks (iterable): Consecutive chunks of the section, as read
+        max_size (int): Maximum number of (encoded) bytes that were read
+
+    Returns:
+        tuple: (decoded text, True if the part was cut at max_size)
+    """
+    charset = part['params'].get('charset') or 'utf-8'
+    parser = BytesFeedParser()
+    parser.feed(f"Content-Type: {part['type']}\r\n"
+                f"Content-Transfer-Encoding: {part['encoding']}\r\n\r\n".encode())
+
+    received = 0
+    pending = b''
+    for chunk in chunks:
+        received += len(chunk)
+        # Feed whole lines only, so a cut never splits an encoded line
+        pending += chunk
+        lines, separator, pending = pending.rpartition(b'\n')
+        if separator:
+            parser.feed(lines + separator)
+    truncated = received >= max_size and part['size'] > max_size
+    if not truncated:
+        parser.feed(pending)
+
+    payload = parser.close().get_payload(decode=True) or b''
+    try:
+        return payload.decode(charset, errors='ignore'), truncated
+    except LookupError:
+        return payload.decode('utf-8', errors='ignore'), truncated
@@ -0,0 +1,233 @@
+import imaplib
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from imap_batch import quote_mailbox
+
+
+class PoolTimeout(Exception):
+    """Raised when no IMAP connection becomes available in time"""
+
+
+class IMAPConnectionPool:
+    """
+    Thread-safe pool of logged-in IMAP connections with the mailbox already selected.
+
+    Connections are created lazily up to max_size, checked with NOOP when they have
+    been idle for more than health_check_interval seconds, logged out after
+    idle_timeout seconds without use and replaced transparently when the server
+    drops them (abort / BYE).
+
+    Args:
+        host (str): IMAP server hostname
+        user (str): Login user
+        password (str): Login password
+        mailbox (str): Mailbox selected on every connection
+        port (int): IMAP SSL port
+        max_size (int): Maximum number of open connections
+        idle_timeout (float): Seconds after which an unused connection is closed
+        wait_timeout (float): Seconds to wait for a free connection before giving up
+        health_check_interval (float): Idle seconds after which NOOP is sent before reuse
+    """
+
+    def __init__(self, host, user, password, mailbox='inbox', port=993, max_size=4,
+                 idle_timeout=300, wait_timeout=10, health_check_interval=30):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.health_check_interval = health_check_interval
+
+        # UIDVALIDITY of the selected mailbox; UIDs are only stable while it is unchanged
+        self.uidvalidity = None
+        self._uidvalidity_listeners = []
+
+        self._idle = deque()  # (connection, last_used) pairs, most recently used on the right
+        self._open = 0
+        self._cond = threading.Condition()
+
+        # Metrics
+        self._created = 0
+        self._reused = 0
+        self._discarded = 0
+        self._expired = 0
+        self._borrowed = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+
+    def _connect(self):
+        mail = imaplib.IMAP4_SSL(self.host, self.port)
+        try:
+            mail.login(self.user, self.password)
+            mail.select(quote_mailbox(self.mailbox))
+            status, data = mail.response('UIDVALIDITY')
+        except Exception:
+            self._close(mail)
+            raise
+        if data and data[0]:
+            self._set_uidvalidity(int(data[0]))
+        return mail
+
+    def _set_uidvalidity(self, uidvalidity):
+        with self._cond:
+            previous = self.uidvalidity
+            self.uidvalidity = uidvalidity
+            listeners = list(self._uidvalidity_listeners)
+        if previous is not None and previous != uidvalidity:
+            print(f"UIDVALIDITY of {self.mailbox} changed from {previous} to {uidvalidity}")
+            for listener in listeners:
+                listener(previous, uidvalidity)
+
+    def on_uidvalidity_change(self, listener):
+        """Register listener(old, new), called when the mailbox UIDVALIDITY changes"""
+        with self._cond:
+            self._uidvalidity_listeners.append(listener)
+
+    def open_connection(self):
+        """Open a dedicated connection that is not counted against the pool"""
+        return self._connect()
+
+    @staticmethod
+    def _close(mail):
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_healthy(mail):
+        try:
+            status, _ = mail.noop()
+            return status == 'OK'
+        except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError):
+            return False
+
+    def _reap_expired(self, now):
+        """Drop idle connections past idle_timeout; caller must hold the lock"""
+        expired = []
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+            self._open -= 1
+            self._expired += 1
+        return expired
+
+    def acquire(self):
+        """Borrow a connection, opening a new one if the pool is not full"""
+        started = time.monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                expired = self._reap_expired(time.monotonic())
+                if self._idle:
+                    mail, last_used = self._idle.pop()
+                    break
+                if self._open < self.max_size:
+                    self._open += 1
+                    mail, last_used = None, None
+                    break
+                remaining = self.wait_timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f'No IMAP connection available after {self.wait_timeout}s')
+                waited = True
+                self._cond.wait(remaining)
+
+            self._borrowed += 1
+            if waited:
+                elapsed = time.monotonic() - started
+                self._waits += 1
+                self._wait_time += elapsed
+                self._max_wait_time = max(self._max_wait_time, elapsed)
+
+        for conn in expired:
+            self._close(conn)
+
+        if mail is not None:
+            if time.monotonic() - last_used <= self.health_check_interval or self._is_healthy(mail):
+                with self._cond:
+                    self._reused += 1
+                return mail
+            # Stale connection (server sent BYE or dropped us): replace it
+            self._close(mail)
+            with self._cond:
+                self._discarded += 1
+
+        try:
+            mail = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created += 1
+        return mail
+
+    def release(self, mail, discard=False):
+        """Return a borrowed connection; discarded connections are logged out"""
+        if discard:
+            self._close(mail)
+        with self._cond:
+            if discard:
+                self._open -= 1
+                self._discarded += 1
+            else:
+                self._idle.append((mail, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager borrowing a connection for the duration of the block"""
+        mail = self.acquire()
+        try:
+            yield mail
+        except (imaplib.IMAP4.abort, OSError):
+            # Connection dropped or server sent BYE: never hand it out again
+            self.release(mail, discard=True)
+            raise
+        except imaplib.IMAP4.error:
+            # Command-level NO/BAD leaves the session usable
+            self.release(mail)
+            raise
+        except BaseException:
+            # The block may have left a command half-read on the wire
+            self.release(mail, discard=True)
+            raise
+        else:
+            self.release(mail)
+
+    def close_all(self):
+        """Log out every idle connection"""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._open -= len(idle)
+        for conn in idle:
+            self._close(conn)
+
+    def metrics(self):
+        """Return a snapshot of pool size and wait statistics"""
+        with self._cond:
+            return {
+                'uidvalidity': self.uidvalidity,
+                'max_size': self.max_size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'created': self._created,
+                'reused': self._reused,
+                'discarded': self._discarded,
+                'expired': self._expired,
+                'borrowed': self._borrowed,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'avg_wait_ms': round(self._wait_time / self._waits * 1000, 2) if self._waits else 0,
+                'max_wait_ms': round(self._max_wait_time * 1000, 2),
+            }
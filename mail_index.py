@@ -0,0 +1,584 @@
+import email
+import fcntl
+import re
+import sqlite3
+import threading
+import time
+
+from email_headers import decode_header_text, extract_addresses
+from imap_batch import FETCH_CHUNK_SIZE, fetch_batched, quote_mailbox, search_uids
+from imap_idle import IdleWatcher
+
+# Bump when the schema changes; the index is a cache and is rebuilt from IMAP
+SCHEMA_VERSION = 3
+
+# Headers naming the addresses an email was delivered to
+RECIPIENT_HEADERS = ('to', 'cc', 'delivered-to', 'x-original-to')
+
+# Everything the index stores comes from headers, flags and size, never bodies
+INDEX_FETCH_ITEMS = '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS (FROM TO CC DELIVERED-TO X-ORIGINAL-TO SUBJECT DATE)])'
+
+# Only the recipient headers, enough to check who an email belongs to
+RECIPIENT_FETCH_ITEMS = '(UID BODY.PEEK[HEADER.FIELDS (TO CC DELIVERED-TO X-ORIGINAL-TO)])'
+
+# Seconds expunged UIDs stay listed for processes that did not sync themselves
+EXPUNGED_RETENTION = 3600
+
+STATUS_PATTERN = re.compile(rb'(MESSAGES|UIDNEXT|UIDVALIDITY) (\d+)')
+
+
+def header_summary(items):
+    """
+    Build the list-view fields of a message from its FETCH items.
+
+    Args:
+        items (dict): Parsed FETCH items including a BODY[HEADER.FIELDS ...] entry
+
+    Returns:
+        dict: from, to, subject, date (decoded text) and size of the message
+    """
+    headers = next((value for key, value in items.items() if key.startswith('BODY[HEADER')), b'')
+    msg = email.message_from_bytes(headers or b'')
+    size = items.get('RFC822.SIZE')
+    return {
+        'from': decode_header_text(msg.get('from')),
+        'to': decode_header_text(msg.get('to')),
+        'subject': decode_header_text(msg.get('subject'), ''),
+        'date': decode_header_text(msg.get('date')),
+        'size': int(size) if size else None
+    }
+
+
+def recipient_hashes(items, domain='ghostinbox.it'):
+    """
+    Return the lowercased local parts of every address at domain an email was sent to.
+
+    Args:
+        items (dict): Parsed FETCH items including a BODY[HEADER.FIELDS ...] entry
+            with some of RECIPIENT_HEADERS
+        domain (str): Domain of the hash addresses
+
+    Returns:
+        set: Recipient hashes found in To, Cc, Delivered-To and X-Original-To
+    """
+    headers = next((value for key, value in items.items() if key.startswith('BODY[HEADER')), b'')
+    msg = email.message_from_bytes(headers or b'')
+    fields = [value for name in RECIPIENT_HEADERS for value in msg.get_all(name, [])]
+    suffix = '@' + domain.lower()
+    hashes = set()
+    for address in extract_addresses(*fields):
+        if address.endswith(suffix):
+            hashes.add(address[:-len(suffix)])
+    return hashes
+
+
+class MailIndex:
+    """
+    Local SQLite (WAL mode) index of inbox metadata, keyed by UID.
+
+    Holds from, to, subject, date, size and flags of every message plus a
+    recipient_hash -> UID table, so alias lookups never hit the IMAP server.
+    It is filled incrementally by sync(), which only fetches UIDs at or above
+    the last seen UIDNEXT.
+
+    Args:
+        path (str): SQLite database file
+        domain (str): Domain whose addresses are indexed as recipient hashes
+    """
+
+    def __init__(self, path, domain='ghostinbox.it'):
+        self.path = path
+        self.domain = domain
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        # recipient_hash -> set of UIDs, mirrored from the recipients table
+        self._owners = {}
+        self._owners_max_uid = 0
+        self._owners_uidvalidity = None
+        self._owners_lock = threading.Lock()
+        self._init_schema()
+        # Last expunged row this process has applied, see apply_expunged()
+        self._expunged_seq = self._connect().execute('SELECT COALESCE(MAX(seq), 0) FROM expunged').fetchone()[0]
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        with conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS messages')
+                conn.execute('DROP TABLE IF EXISTS recipients')
+                conn.execute('DROP TABLE IF EXISTS state')
+                conn.execute('DROP TABLE IF EXISTS expunged')
+            conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                uid INTEGER PRIMARY KEY,
+                sender TEXT,
+                recipient TEXT,
+                subject TEXT,
+                date TEXT,
+                size INTEGER,
+                flags TEXT
+            )''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS recipients (
+                recipient_hash TEXT NOT NULL,
+                uid INTEGER NOT NULL,
+                PRIMARY KEY (recipient_hash, uid)
+            ) WITHOUT ROWID''')
+            conn.execute('CREATE INDEX IF NOT EXISTS recipients_uid ON recipients (uid)')
+            conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)')
+            # UIDs removed by sync(), so every process can forget them
+            conn.execute('''CREATE TABLE IF NOT EXISTS expunged (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                uid INTEGER NOT NULL,
+                removed_at INTEGER NOT NULL
+            )''')
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def _get_state(self, key):
+        row = self._connect().execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def uidvalidity(self):
+        return self._get_state('uidvalidity')
+
+    def is_ready(self):
+        """True once at least one sync has completed"""
+        return self._get_state('last_sync') is not None
+
+    def search(self, hash, limit=0, before=None, after=None):
+        """
+        List emails sent to a hash address, newest first.
+
+        Args:
+            hash (str): sha256 hash of the alias
+            limit (int): Maximum number of emails to return, 0 for all
+            before (int): Only return emails with a UID below this one
+            after (int): Only return emails with a UID above this one
+
+        Returns:
+            list: Email header dicts in the same shape as app.get_emails()
+        """
+        sql = 'SELECT m.* FROM recipients r JOIN messages m ON m.uid = r.uid WHERE r.recipient_hash = ?'
+        params = [hash.lower()]
+        if before is not None:
+            sql += ' AND r.uid < ?'
+            params.append(before)
+        if after is not None:
+            sql += ' AND r.uid > ?'
+            params.append(after)
+        sql += ' ORDER BY r.uid DESC'
+        if limit > 0:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        uidvalidity = self.uidvalidity
+        return [self._summary(row, uidvalidity) for row in self._connect().execute(sql, params)]
+
+    @staticmethod
+    def _summary(row, uidvalidity):
+        return {
+            'id': str(row['uid']),
+            'uidvalidity': uidvalidity,
+            'from': row['sender'],
+            'to': row['recipient'],
+            'subject': row['subject'],
+            'date': row['date'],
+            'size': row['size']
+        }
+
+    def get(self, uid):
+        """Return the header dict of one indexed email, as in search(), or None"""
+        row = self._connect().execute('SELECT * FROM messages WHERE uid = ?', (uid,)).fetchone()
+        return self._summary(row, self.uidvalidity) if row else None
+
+    def alias_state(self, hash):
+        """
+        Summarize the emails of a hash address in two numbers.
+
+        UIDs only grow, so any email arriving or being expunged changes the
+        count or the highest UID: together with UIDVALIDITY they identify the
+        current list of emails without reading it.
+
+        Args:
+            hash (str): sha256 hash of the alias
+
+        Returns:
+            tuple: (number of emails, highest UID or 0)
+        """
+        return tuple(self._connect().execute(
+            'SELECT COUNT(*), COALESCE(MAX(uid), 0) FROM recipients WHERE recipient_hash = ?', (hash.lower(),)
+        ).fetchone())
+
+    @property
+    def last_change(self):
+        """UNIX time of the last sync that added or removed emails, None if unknown"""
+        return self._get_state('last_change')
+
+    def owns(self, hash, uid):
+        """
+        Tell from memory whether an email was sent to a hash address.
+
+        Answers from an in-memory recipient_hash -> UIDs map, loaded from the
+        recipients table and extended incrementally as the index grows (other
+        processes may be the ones syncing it). UIDs are never reused within a
+        UIDVALIDITY, so entries only need dropping when it changes.
+
+        Args:
+            hash (str): sha256 hash of the alias
+            uid (int): Message UID
+
+        Returns:
+            bool: Whether the email belongs to hash, or None when the UID has not
+                been indexed yet and the index cannot tell
+        """
+        hash = hash.lower()
+        uidvalidity = self.uidvalidity
+        with self._owners_lock:
+            if uidvalidity != self._owners_uidvalidity:
+                self._owners = {}
+                self._owners_max_uid = 0
+                self._owners_uidvalidity = uidvalidity
+            if uid in self._owners.get(hash, ()):
+                return True
+            if uid > self._owners_max_uid:
+                # Pick up rows indexed since the last load
+                for recipient_hash, row_uid in self._connect().execute(
+                        'SELECT recipient_hash, uid FROM recipients WHERE uid > ?', (self._owners_max_uid,)):
+                    self._owners.setdefault(recipient_hash, set()).add(row_uid)
+                    self._owners_max_uid = max(self._owners_max_uid, row_uid)
+                if uid in self._owners.get(hash, ()):
+                    return True
+        if uid >= (self._get_state('uidnext') or 1):
+            return None
+        return False
+
+    def max_uid(self):
+        """Return the highest indexed UID, 0 when the index is empty"""
+        return self._connect().execute('SELECT COALESCE(MAX(uid), 0) FROM messages').fetchone()[0]
+
+    def recipients_since(self, uid):
+        """Return {recipient_hash: highest UID} for messages indexed after uid"""
+        return dict(self._connect().execute(
+            'SELECT recipient_hash, MAX(uid) FROM recipients WHERE uid > ? GROUP BY recipient_hash', (uid,)
+        ))
+
+    def sync(self, mail, mailbox='inbox'):
+        """
+        Bring the index up to date with the selected mailbox.
+
+        Only UIDs at or above the stored UIDNEXT are fetched. Expunged messages
+        are detected by comparing message counts and removed. A UIDVALIDITY
+        change drops the whole index and rebuilds it.
+
+        Args:
+            mail (imaplib.IMAP4): Connection with mailbox selected
+            mailbox (str): Name of the selected mailbox, used for STATUS
+
+        Returns:
+            dict: Number of messages added and removed, and the removed UIDs
+        """
+        with self._sync_lock:
+            status, data = mail.status(quote_mailbox(mailbox), '(MESSAGES UIDNEXT UIDVALIDITY)')
+            if status != 'OK':
+                raise mail.error(f'STATUS failed: {data}')
+            server = {key.decode(): int(value) for key, value in STATUS_PATTERN.findall(b' '.join(data))}
+
+            conn = self._connect()
+            rebuilt = server['UIDVALIDITY'] != self.uidvalidity
+            if rebuilt:
+                with conn:
+                    conn.execute('DELETE FROM messages')
+                    conn.execute('DELETE FROM recipients')
+                    conn.execute('DELETE FROM expunged')
+                    conn.execute("INSERT OR REPLACE INTO state VALUES ('uidvalidity', ?)", (server['UIDVALIDITY'],))
+                    conn.execute("INSERT OR REPLACE INTO state VALUES ('uidnext', 1)")
+
+            added = 0
+            uidnext = self._get_state('uidnext') or 1
+            if server['UIDNEXT'] > uidnext:
+                new_uids = [uid for uid in search_uids(mail, 'UID', f'{uidnext}:*') if uid >= uidnext]
+                batch = []
+                # Each stored batch moves uidnext on, so a failed round resumes after it
+                for uid, items in fetch_batched(mail, new_uids, INDEX_FETCH_ITEMS, uid=True):
+                    batch.append((uid, items))
+                    if len(batch) >= FETCH_CHUNK_SIZE:
+                        added += self._store(conn, batch)
+                        batch = []
+                added += self._store(conn, batch)
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO state VALUES ('uidnext', ?)", (server['UIDNEXT'],))
+
+            removed = []
+            indexed = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+            if indexed != server['MESSAGES']:
+                removed = self._remove_missing(conn, set(search_uids(mail, 'ALL')))
+
+            now = int(time.time())
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO state VALUES ('last_sync', ?)", (now,))
+                if added or removed or rebuilt or self._get_state('last_change') is None:
+                    conn.execute("INSERT OR REPLACE INTO state VALUES ('last_change', ?)", (now,))
+            return {'added': added, 'removed': len(removed), 'removed_uids': removed}
+
+    def _store(self, conn, batch):
+        """Insert a batch of (uid, FETCH items) in one transaction and move uidnext past it"""
+        messages = []
+        recipients = []
+        for uid, items in batch:
+            try:
+                summary = header_summary(items)
+                flags = ' '.join(flag.decode(errors='replace') for flag in (items.get('FLAGS') or []))
+                hashes = recipient_hashes(items, self.domain)
+            except Exception as e:
+                # One unreadable message must not hold back the ones after it
+                print(f"Index: skipping UID {uid}: {e}")
+                continue
+            messages.append((uid, summary['from'], summary['to'], summary['subject'],
+                             summary['date'], summary['size'], flags))
+            recipients.extend((recipient_hash, uid) for recipient_hash in hashes)
+        if not batch:
+            return 0
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)', messages)
+            conn.executemany('INSERT OR IGNORE INTO recipients VALUES (?, ?)', recipients)
+            conn.execute("UPDATE state SET value = MAX(value, ?) WHERE key = 'uidnext'", (max(uid for uid, _ in batch) + 1,))
+        with self._owners_lock:
+            for recipient_hash, uid in recipients:
+                self._owners.setdefault(recipient_hash, set()).add(uid)
+        return len(messages)
+
+    def _remove_missing(self, conn, server_uids):
+        stale = [row[0] for row in conn.execute('SELECT uid FROM messages') if row[0] not in server_uids]
+        now = int(time.time())
+        with conn:
+            conn.executemany('DELETE FROM messages WHERE uid = ?', [(uid,) for uid in stale])
+            conn.executemany('DELETE FROM recipients WHERE uid = ?', [(uid,) for uid in stale])
+            conn.executemany('INSERT INTO expunged (uid, removed_at) VALUES (?, ?)', [(uid, now) for uid in stale])
+            conn.execute('DELETE FROM expunged WHERE removed_at < ?', (now - EXPUNGED_RETENTION,))
+        stale_set = set(stale)
+        with self._owners_lock:
+            for uids in self._owners.values():
+                uids -= stale_set
+        return stale
+
+    def apply_expunged(self):
+        """
+        Forget UIDs expunged since the last call, whichever process synced them.
+
+        Only the sync leader sees the removals happen, so every process calls
+        this while polling the index to keep its own caches in step.
+
+        Returns:
+            list: UIDs removed from the index since the last call
+        """
+        rows = self._connect().execute(
+            'SELECT seq, uid FROM expunged WHERE seq > ? ORDER BY seq', (self._expunged_seq,)
+        ).fetchall()
+        if not rows:
+            return []
+        self._expunged_seq = rows[-1][0]
+        removed = [uid for _, uid in rows]
+        removed_set = set(removed)
+        with self._owners_lock:
+            for uids in self._owners.values():
+                uids -= removed_set
+        return removed
+
+    def stats(self):
+        """Return index size and sync state"""
+        conn = self._connect()
+        return {
+            'messages': conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0],
+            'uidvalidity': self.uidvalidity,
+            'uidnext': self._get_state('uidnext'),
+            'last_sync': self._get_state('last_sync'),
+            'last_change': self.last_change
+        }
+
+
+class IndexSyncWorker(threading.Thread):
+    """
+    Background thread keeping a MailIndex in sync with the IMAP inbox.
+
+    Only one process syncs at a time: the worker holding an exclusive lock on
+    <index path>.lock does the work, so several app workers sharing the same
+    index file still show up as a single client on the IMAP server. With idle
+    enabled the leader also runs an IdleWatcher, and every EXISTS/EXPUNGE it
+    reports triggers an immediate sync; the interval is then only a safety net.
+
+    Args:
+        index (MailIndex): Index to update
+        pool (IMAPConnectionPool): Pool to borrow the sync connection from
+        interval (float): Seconds between sync rounds
+        idle (bool): Push changes with IMAP IDLE (or NOOP polling) as they happen
+        on_sync (callable): Called with the sync result whenever messages were added or removed
+    """
+
+    def __init__(self, index, pool, interval=10, idle=False, on_sync=None):
+        super().__init__(name='index-sync', daemon=True)
+        self.index = index
+        self.pool = pool
+        self.interval = interval
+        self.idle = idle
+        self.on_sync = on_sync
+        self.watcher = None
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._lock_file = None
+
+    def _is_leader(self):
+        if self._lock_file is None:
+            lock_file = open(self.index.path + '.lock', 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        return True
+
+    def wake(self, events=None):
+        """Request a sync round now instead of at the next interval"""
+        self._wake_event.set()
+
+    def sync_once(self):
+        with self.pool.connection() as mail:
+            return self.index.sync(mail, self.pool.mailbox)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
+            if self._is_leader():
+                if self.idle and self.watcher is None:
+                    self.watcher = IdleWatcher(self.pool, on_change=self.wake)
+                    self.watcher.start()
+                try:
+                    result = self.sync_once()
+                    if result['added'] or result['removed']:
+                        print(f"Index sync: {result['added']} added, {result['removed']} removed")
+                        if self.on_sync is not None:
+                            self.on_sync(result)
+                except Exception as e:
+                    print(f"Error syncing index: {e}")
+            self._wake_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+        if self.watcher is not None:
+            self.watcher.stop()
+
+
+class IndexNotifier(threading.Thread):
+    """
+    Wakes up requests waiting for new mail on a recipient hash.
+
+    One notifier per process watches the shared index (a cheap local query
+    every poll_interval seconds, or immediately when notify() is called by the
+    sync worker) and signals only the waiters whose hash received mail, so any
+    number of waiting clients costs no IMAP work at all. Expunges synced by
+    any process are applied to the index and passed to on_expunge.
+
+    Args:
+        index (MailIndex): Index to watch
+        poll_interval (float): Seconds between index checks
+        on_expunge (callable): Called with the list of UIDs removed from the index
+    """
+
+    def __init__(self, index, poll_interval=0.5, on_expunge=None):
+        super().__init__(name='index-notifier', daemon=True)
+        self.index = index
+        self.poll_interval = poll_interval
+        self.on_expunge = on_expunge
+        self._waiters = {}  # recipient hash -> set of threading.Event
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._last_uid = None
+        self._uidvalidity = None
+
+    def notify(self, result=None):
+        """Check the index now instead of at the next poll"""
+        self._wake_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.wait(self.poll_interval)
+            self._wake_event.clear()
+            try:
+                self._check()
+            except Exception as e:
+                print(f"Error checking index for new mail: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def _check(self):
+        removed = self.index.apply_expunged()
+        if removed and self.on_expunge is not None:
+            self.on_expunge(removed)
+
+        uidvalidity = self.index.uidvalidity
+        if self._last_uid is None or uidvalidity != self._uidvalidity:
+            # First run or index rebuilt: wake everybody to re-read
+            self._uidvalidity = uidvalidity
+            self._last_uid = self.index.max_uid()
+            with self._lock:
+                events = [event for waiters in self._waiters.values() for event in waiters]
+        else:
+            changed = self.index.recipients_since(self._last_uid)
+            if not changed:
+                return
+            self._last_uid = max(changed.values())
+            with self._lock:
+                events = [event for hash in changed for event in self._waiters.get(hash, ())]
+        for event in events:
+            event.set()
+
+    def wait_for_new(self, hash, after_uid, timeout):
+        """
+        Block until the index has mail for hash with a UID above after_uid.
+
+        Args:
+            hash (str): sha256 hash of the alias
+            after_uid (int): Only messages with a higher UID count as new
+            timeout (float): Maximum seconds to wait
+
+        Returns:
+            list: New email header dicts, newest first; empty on timeout
+        """
+        hash = hash.lower()
+        deadline = time.monotonic() + timeout
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(hash, set()).add(event)
+        try:
+            while True:
+                # Registered before searching, so mail arriving in between still wakes us
+                emails = self.index.search(hash, after=after_uid)
+                remaining = deadline - time.monotonic()
+                if emails or remaining <= 0:
+                    return emails
+                event.wait(remaining)
+                event.clear()
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(hash)
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[hash]
+
+    def waiting(self):
+        """Number of requests currently waiting"""
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
@@ -0,0 +1,529 @@
+from datetime import datetime, timedelta
+import imaplib
+import email
+import json
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from email_headers import decode_header_text, extract_email_from_to_field, parse_date_header
+from imap_batch import FETCH_CHUNK_SIZE, chunked, fetch_batched, quote_mailbox, store_batched, search_uids, to_sequence_set
+from metadata_columns import MetadataColumns
+from shards import load_shards
+
+# Load environment variables
+load_dotenv()
+
+# Email configuration
+EMAIL_ADDRESS = os.getenv('BASE_EMAIL')
+IMAP_SERVER = 'imapmail.libero.it'
+
+# Backing mailboxes, each holding the emails of a range of alias hashes
+SHARDS = load_shards()
+
+# Retention policy, applied with server-side searches
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 30))               # delete emails older than this
+RETENTION_MAX_SIZE = int(os.getenv('RETENTION_MAX_SIZE', 0))        # delete emails larger than this (bytes, 0 = no cap)
+RETENTION_DOMAIN = os.getenv('RETENTION_DOMAIN', 'ghostinbox.it')   # delete emails not sent to this domain
+RETENTION_TRASH = os.getenv('RETENTION_TRASH')                      # move deleted emails here instead, if set
+
+# Search keys for the headers a recipient address may appear in (as in mail_index.RECIPIENT_HEADERS)
+RECIPIENT_SEARCH_KEYS = (('TO',), ('CC',), ('HEADER', 'Delivered-To'), ('HEADER', 'X-Original-To'))
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# Where the state of the previous run is kept
+CHECKPOINT_PATH = os.getenv('MAINTENANCE_CHECKPOINT', 'maintenance_checkpoint.json')
+CHECKPOINT_VERSION = 2
+
+# Large batches of new emails are fetched over several sessions at once
+SCAN_CONNECTIONS = int(os.getenv('MAINTENANCE_SCAN_CONNECTIONS', 1))    # sessions per scan (1 = serial)
+MAX_ACCOUNT_CONNECTIONS = int(os.getenv('IMAP_MAX_CONNECTIONS', 4))     # sessions the account may have open at once
+
+# Headers, size and arrival date only: bodies are never downloaded. The Date
+# header is only used when the server gives no INTERNALDATE
+MAINTENANCE_FETCH_ITEMS = '(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT DATE)])'
+
+STATUS_PATTERN = re.compile(rb'(MESSAGES|UIDNEXT|UIDVALIDITY) (\d+)')
+
+
+def load_checkpoint(path=CHECKPOINT_PATH):
+    """
+    Load the state saved by the previous run.
+
+    Returns:
+        dict: uidvalidity, last_uid, the MetadataColumns of every email and
+            the spam_folder of the account if known, or None when there is no
+            usable checkpoint
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        # Checkpoints in an older layout are rebuilt from scratch
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            return None
+        checkpoint['columns'] = MetadataColumns.from_dict(checkpoint['columns'])
+        return checkpoint
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_checkpoint(checkpoint, path=CHECKPOINT_PATH):
+    # Write then rename, so an interrupted run never leaves a truncated checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({**checkpoint, 'columns': checkpoint['columns'].to_dict()}, f)
+    os.replace(tmp_path, path)
+
+
+def new_checkpoint(uidvalidity):
+    return {
+        'version': CHECKPOINT_VERSION,
+        'uidvalidity': uidvalidity,
+        'last_uid': 0,
+        'columns': MetadataColumns()
+    }
+
+
+def parse_internaldate(value):
+    """Convert an INTERNALDATE value to a UNIX timestamp, None if unparseable"""
+    if not value:
+        return None
+    parsed = imaplib.Internaldate2tuple(b'INTERNALDATE "' + bytes(value) + b'"')
+    return time.mktime(parsed) if parsed else None
+
+
+def imap_date(value):
+    """Format a date as an IMAP search date (e.g. 01-Oct-2025), independent of the locale"""
+    return f'{value.day:02d}-{MONTHS[value.month - 1]}-{value.year}'
+
+
+def recipient_criteria(domain, negate=False):
+    """
+    Search criteria for emails with an @domain address in any recipient header.
+
+    Args:
+        domain (str): Recipient domain
+        negate (bool): Match the emails with no such address in any of them instead
+
+    Returns:
+        list: UID SEARCH arguments
+    """
+    keys = [[*key, f'@{domain}'] for key in RECIPIENT_SEARCH_KEYS]
+    if negate:
+        return [arg for key in keys for arg in ['NOT', *key]]
+    return ['OR'] * (len(keys) - 1) + [arg for key in keys for arg in key]
+
+
+def delete_uids(mail, uids, trash=RETENTION_TRASH):
+    """
+    Remove messages from the selected mailbox with as few commands as possible.
+
+    With a trash folder and a server supporting MOVE the messages are moved
+    there. Otherwise they are flagged \\Deleted with one UID STORE per chunk
+    and expunged, only these UIDs when the server supports UIDPLUS.
+
+    Args:
+        mail (imaplib.IMAP4): Connection with the mailbox selected
+        uids (list): UIDs to remove
+        trash (str): Folder to move the messages to, None to expunge them
+    """
+    if not uids:
+        return
+    capabilities = mail.capabilities
+    if trash and 'MOVE' in capabilities:
+        move_uids(mail, uids, trash)
+        return
+
+    store_batched(mail, uids, '+FLAGS', '\\Deleted', uid=True)
+    if 'UIDPLUS' in capabilities:
+        # Leaves alone anything else that is flagged \Deleted
+        for chunk in chunked(uids, FETCH_CHUNK_SIZE * 10):
+            mail.uid('EXPUNGE', to_sequence_set(chunk))
+    else:
+        mail.expunge()
+
+
+def move_uids(mail, uids, folder):
+    """
+    Move messages from the selected mailbox to another folder with as few commands as possible.
+
+    Uses one UID MOVE per chunk of the UID set when the server supports MOVE
+    (RFC 6851), otherwise one UID COPY per chunk followed by delete_uids().
+
+    Args:
+        mail (imaplib.IMAP4): Connection with the mailbox selected
+        uids (list): UIDs to move
+        folder (str): Destination folder
+    """
+    if not uids:
+        return
+    command = 'MOVE' if 'MOVE' in mail.capabilities else 'COPY'
+    for chunk in chunked(uids, FETCH_CHUNK_SIZE * 10):
+        status, data = mail.uid(command, to_sequence_set(chunk), quote_mailbox(folder))
+        if status != 'OK':
+            raise mail.error(f'{command} failed: {data}')
+    if command == 'COPY':
+        delete_uids(mail, uids, trash=None)
+
+
+def apply_retention(mail, days=RETENTION_DAYS, max_size=RETENTION_MAX_SIZE, domain=RETENTION_DOMAIN):
+    """
+    Delete the emails the retention policy rejects, letting the server find them.
+
+    Nothing is fetched: one UID SEARCH per rule selects the emails that are
+    older than days (by arrival date), not addressed to domain in any
+    recipient header (To, Cc, Delivered-To, X-Original-To), or larger
+    than max_size, and the union is removed with delete_uids().
+
+    Args:
+        mail (imaplib.IMAP4): Connection with the mailbox selected
+        days (int): Maximum age in days
+        max_size (int): Maximum size in bytes, 0 for no cap
+        domain (str): Domain every kept email must be addressed to
+
+    Returns:
+        dict: Sets of UIDs 'expired', 'foreign', 'oversized' and their union 'deleted'
+    """
+    cutoff = datetime.now() - timedelta(days=days)
+    result = {
+        'expired': set(search_uids(mail, 'BEFORE', imap_date(cutoff))),
+        'foreign': set(search_uids(mail, *recipient_criteria(domain, negate=True))),
+        'oversized': set(search_uids(mail, 'LARGER', str(max_size))) if max_size else set()
+    }
+    result['deleted'] = result['expired'] | result['foreign'] | result['oversized']
+    delete_uids(mail, sorted(result['deleted']))
+    return result
+
+
+def _scan_records(mail, uids):
+    """Fetch the metadata records (uid, received, size, sender, receiver, subject) of uids"""
+    records = []
+    for uid, items in fetch_batched(mail, uids, MAINTENANCE_FETCH_ITEMS, uid=True):
+        headers = next((value for key, value in items.items() if key.startswith('BODY[HEADER')), b'')
+        msg = email.message_from_bytes(headers or b'')
+        from_ = decode_header_text(msg.get('from'), 'Unknown')
+        to_ = decode_header_text(msg.get('to'), 'Unknown')
+
+        subject = decode_header_text(msg.get('subject'), 'No Subject')
+
+        records.append((
+            uid,
+            parse_internaldate(items.get('INTERNALDATE')) or parse_date_header(msg['date']),
+            int(items.get('RFC822.SIZE') or 0),
+            extract_email_from_to_field(from_) or from_,
+            extract_email_from_to_field(to_) or to_,
+            subject[:100]
+        ))
+    return records
+
+
+def _scan_range(reconnect, mailbox, uids):
+    """Fetch the records of uids over a session of its own"""
+    mail = reconnect()
+    try:
+        status, data = mail.select(quote_mailbox(mailbox), readonly=True)
+        if status != 'OK':
+            raise mail.error(f'SELECT failed: {data}')
+        return _scan_records(mail, uids)
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+
+def scan_uids(mail, mailbox, uids, connections=SCAN_CONNECTIONS, max_connections=MAX_ACCOUNT_CONNECTIONS,
+              reconnect=None):
+    """
+    Fetch the metadata records of many emails, over several IMAP sessions when worthwhile.
+
+    The sorted UIDs are split into contiguous ranges, one per session. The
+    first range is read over mail and each other range over a session of its
+    own, all in a thread pool. The ranges are joined in UID order whatever
+    order they finish in, so the result does not depend on timing.
+
+    Args:
+        mail (imaplib.IMAP4): Logged-in connection with mailbox selected
+        mailbox (str): Name of the selected mailbox
+        uids (list): UIDs to fetch
+        connections (int): Sessions to scan with, 1 for a serial scan over mail
+        max_connections (int): Sessions the account may have open at once, mail included
+        reconnect (callable): Opens another logged-in connection to the same
+            account, None for a serial scan over mail
+
+    Returns:
+        list: Records (uid, received, size, sender, receiver, subject) in UID order
+    """
+    uids = sorted(uids)
+    # Below a couple of FETCH chunks per session the extra logins cost more than they save
+    sessions = min(connections, max_connections, len(uids) // (FETCH_CHUNK_SIZE * 2))
+    if sessions < 2 or reconnect is None:
+        return _scan_records(mail, uids)
+
+    bounds = [len(uids) * session // sessions for session in range(sessions + 1)]
+    ranges = [uids[start:end] for start, end in zip(bounds, bounds[1:])]
+    print(f"🔀 Scanning {len(uids)} emails over {sessions} IMAP sessions")
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = [executor.submit(_scan_records, mail, ranges[0])]
+        futures += [executor.submit(_scan_range, reconnect, mailbox, uid_range) for uid_range in ranges[1:]]
+        return [record for future in futures for record in future.result()]
+
+
+def _row(record, status, now):
+    uid, received, size, sender, receiver, subject = record
+    return {
+        'uid': uid,
+        'from_': sender,
+        'to_': receiver,
+        'subject': subject,
+        'age_days': int((now - received) // 86400) if received else 'N/A',
+        'size': size,
+        'status': status
+    }
+
+
+def maintain_mailbox(mail, mailbox='inbox', checkpoint_path=CHECKPOINT_PATH, reconnect=None,
+                     max_connections=MAX_ACCOUNT_CONNECTIONS, spam_folder=None):
+    """
+    Apply the retention policy to one mailbox and bring its checkpoint up to date.
+
+    Deletions are found by the server with apply_retention(). Of the emails
+    left, only UIDs above the checkpoint of the previous run are fetched, and
+    then only their headers, size and INTERNALDATE. Everything else is
+    answered from the metadata columns kept in the checkpoint.
+
+    Args:
+        mail (imaplib.IMAP4): Logged-in connection with mailbox selected
+        mailbox (str): Name of the selected mailbox
+        checkpoint_path (str): File holding the state between runs
+        reconnect (callable): Opens another connection to the account, for
+            parallel scans; None to always scan over mail
+        max_connections (int): Sessions this mailbox may have open at once, mail included
+        spam_folder (str): Spam folder of the account just resolved, kept in
+            the checkpoint so later runs skip the lookup
+
+    Returns:
+        dict: 'columns' of every email left, 'retention' as returned by
+            apply_retention() and 'processed' rows (from, to, subject, age,
+            size, status) for the emails fetched or deleted in this run
+    """
+    now = time.time()
+    processed = []
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    retention = apply_retention(mail)
+    print(f"🗑️  Retention removed {len(retention['deleted'])} emails from {mailbox} "
+          f"({len(retention['expired'])} older than {RETENTION_DAYS} days, "
+          f"{len(retention['foreign'])} not sent to @{RETENTION_DOMAIN}, "
+          f"{len(retention['oversized'])} too large)")
+
+    status, data = mail.status(quote_mailbox(mailbox), '(MESSAGES UIDNEXT UIDVALIDITY)')
+    if status != 'OK':
+        raise mail.error(f'STATUS failed: {data}')
+    server = {key.decode(): int(value) for key, value in STATUS_PATTERN.findall(b' '.join(data))}
+
+    # The spam folder does not depend on the UIDs of this mailbox
+    spam_folder = spam_folder or (checkpoint or {}).get('spam_folder')
+    if checkpoint is None or checkpoint['uidvalidity'] != server['UIDVALIDITY']:
+        checkpoint = new_checkpoint(server['UIDVALIDITY'])
+    if spam_folder:
+        checkpoint['spam_folder'] = spam_folder
+
+    columns = checkpoint['columns']
+
+    # Emails seen by an earlier run can still be reported
+    processed.extend(_row(record, 'Deleted', now) for record in columns.remove(retention['deleted']))
+
+    # Only emails that arrived since the last run are fetched
+    last_uid = checkpoint['last_uid']
+    new_uids = [uid for uid in search_uids(mail, 'UID', f'{last_uid + 1}:*') if uid > last_uid]
+    print(f"📧 {len(new_uids)} new emails in {mailbox} since last run (checkpoint UID {last_uid})")
+
+    for record in scan_uids(mail, mailbox, new_uids, max_connections=max_connections, reconnect=reconnect):
+        columns.add(*record)
+        checkpoint['last_uid'] = max(checkpoint['last_uid'], record[0])
+        processed.append(_row(record, 'Kept', now))
+
+    # Drop records of emails removed outside this engine; the UID SEARCH is
+    # only needed when the counts disagree
+    if len(columns) != server['MESSAGES']:
+        columns.retain(search_uids(mail, 'ALL'))
+
+    save_checkpoint(checkpoint, checkpoint_path)
+    return {'columns': columns, 'retention': retention, 'processed': processed}
+
+
+def summarize(results, imap_server=IMAP_SERVER, email_account=EMAIL_ADDRESS):
+    """
+    Compute the statistics of one or more mailboxes from their metadata columns.
+
+    Every aggregate is a reduction over one column per mailbox; counters are
+    added up in mailbox order, so ties in the top lists break the same way on
+    every run.
+
+    Args:
+        results (list): Results of maintain_mailbox(), one per mailbox
+        imap_server (str): Server name shown on the stats page
+        email_account (str): Account name shown on the stats page
+
+    Returns:
+        dict: The statistics used by stats.generate_static_stats_page(), plus
+            the 'processed' rows of every mailbox
+    """
+    now = time.time()
+    stores = [result['columns'] for result in results]
+    histograms = [columns.age_histogram(now) for columns in stores]
+    recent_emails, older_emails, very_old_emails = [sum(counts) for counts in zip(*histograms)] if stores else (0, 0, 0)
+    largest_email_size = max((columns.largest_size() for columns in stores), default=0)
+    total_emails = sum(len(columns) for columns in stores)
+    total_size = sum(columns.total_size() for columns in stores)
+    senders = sum((columns.counts('senders') for columns in stores), Counter())
+    receivers = sum((columns.counts('receivers') for columns in stores), Counter())
+    foreign = sum(len(result['retention']['foreign']) for result in results)
+    deleted = sum(len(result['retention']['deleted'] - result['retention']['foreign']) for result in results)
+
+    # The newest emails, as listed on the stats page; UIDs only order emails
+    # within one mailbox, so several mailboxes are merged by arrival time
+    newest = [record for columns in stores for record in columns.newest(10)]
+    if len(stores) > 1:
+        newest = sorted(newest, key=lambda record: -(record[1] or 0))[:10]
+    recent_emails_list = []
+    for record in newest:
+        recent = _row(record, 'Kept', now)
+        recent['size_kb'] = round(recent.pop('size') / 1024, 1)
+        del recent['uid']
+        recent_emails_list.append(recent)
+
+    return {
+        'total_emails': total_emails,
+        'non_ghostinbox_deleted': foreign,
+        'unique_senders': len(senders),
+        'unique_receivers': len(receivers),
+        'deleted_count': deleted,
+        'total_size_mb': round(total_size / (1024 * 1024), 1),
+        'avg_size_kb': round(total_size / total_emails / 1024, 1) if total_emails > 0 else 0,
+        'largest_email_kb': round(largest_email_size / 1024, 1),
+        'recent_emails': recent_emails,
+        'older_emails': older_emails,
+        'very_old_emails': very_old_emails,
+        'recent_emails_list': recent_emails_list,
+        'top_senders': [{'email': email, 'count': count} for email, count in senders.most_common(5)],
+        'top_receivers': [{'email': email, 'count': count} for email, count in receivers.most_common(5)],
+        'imap_server': imap_server,
+        'email_account': email_account,
+        'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'processed': [row for result in results for row in result['processed']]
+    }
+
+
+def _rescue_spam(shard, shards):
+    """
+    Move mail for the domain out of the spam folder of a shard's account, into the shards' folders.
+
+    Returns:
+        str: Spam folder used, for the shard's checkpoint, or None
+    """
+    # Imported here: cleanup builds on this module
+    from cleanup import check_and_move_spam_emails
+    checkpoint = load_checkpoint(shard.path(CHECKPOINT_PATH, len(shards))) or {}
+    mail = shard.connect()
+    try:
+        return check_and_move_spam_emails(mail, account=shard.account, inbox=shard.mailbox, shards=shards,
+                                          spam_folder=checkpoint.get('spam_folder'))
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+
+def _maintain_shard(shard, shards, max_connections, spam_folder=None):
+    mail = shard.connect()
+    try:
+        status, data = mail.select(quote_mailbox(shard.mailbox))
+        if status != 'OK':
+            raise mail.error(f'SELECT {shard.mailbox} failed: {data}')
+        return maintain_mailbox(mail, shard.mailbox, shard.path(CHECKPOINT_PATH, len(shards)),
+                                reconnect=shard.connect, max_connections=max_connections,
+                                spam_folder=spam_folder)
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+
+def run_sharded_maintenance(shards=SHARDS, rescue_spam=False):
+    """
+    Maintain every shard at once, each over its own connection, and summarize them together.
+
+    The connection cap of an account is split between the shards that are
+    folders of it, so parallel scans never exceed IMAP_MAX_CONNECTIONS. An
+    account with more shards than that maintains the rest as others finish.
+
+    Args:
+        shards (list): Shards as returned by shards.load_shards()
+        rescue_spam (bool): First move emails for the domain out of the spam
+            folder of each account, each into the folder of its shard
+
+    Returns:
+        dict: As returned by summarize()
+    """
+    accounts = Counter(shard.account for shard in shards)
+    first_of_account = {}
+    for shard in shards:
+        first_of_account.setdefault(shard.account, shard)
+
+    # The spam folder of an account is kept in the checkpoint of its first shard
+    spam_folders = {}
+    if rescue_spam:
+        # Rescued mail may go to any folder shard of the account, so spam is
+        # handled before the shards are maintained in parallel
+        for shard in first_of_account.values():
+            spam_folders[shard.name] = _rescue_spam(shard, shards)
+
+    # One executor per account, sized so its running shards share the cap
+    executors = {
+        account: ThreadPoolExecutor(max_workers=min(count, MAX_ACCOUNT_CONNECTIONS))
+        for account, count in accounts.items()
+    }
+    try:
+        futures = [executors[shard.account].submit(
+            _maintain_shard, shard, shards,
+            max(1, MAX_ACCOUNT_CONNECTIONS // min(accounts[shard.account], MAX_ACCOUNT_CONNECTIONS)),
+            spam_folders.get(shard.name)
+        ) for shard in shards]
+        results = [future.result() for future in futures]
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+    return summarize(
+        results,
+        imap_server=', '.join(dict.fromkeys(shard.server for shard in shards)),
+        email_account=shards[0].user if len(shards) == 1 else ', '.join(shard.name for shard in shards)
+    )
+
+
+def main():
+    # Imported here: both scripts build on this module
+    from cleanup import print_report
+    from stats import generate_static_stats_page
+
+    print(f"🎯 GhostInbox Maintenance")
+    print(f"=" * 50)
+    # Spam rescue first, then every shard in parallel
+    stats = run_sharded_maintenance(rescue_spam=True)
+
+    print_report(stats)
+    static_file = generate_static_stats_page(stats)
+    print(f"📁 Static stats page saved to: {static_file}")
+    print(f"=" * 50)
+    print(f"✅ Process completed successfully!")
+
+
+if __name__ == '__main__':
+    main()
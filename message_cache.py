@@ -0,0 +1,431 @@
+import json
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+
+def estimate_size(value):
+    """Rough in-memory size in bytes of a parsed message dict"""
+    if isinstance(value, dict):
+        return sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(item) for item in value)
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return 8
+
+
+class MessageCache:
+    """
+    Thread-safe LRU cache with a time-to-live, bounded by total size in bytes.
+
+    Message bodies vary from a few hundred bytes to megabytes, so eviction is
+    driven by the summed estimate_size() of the cached values, not by entry
+    count. Entries older than ttl seconds are treated as missing.
+
+    Args:
+        max_bytes (int): Upper bound for the summed size of cached values
+        ttl (float): Seconds an entry stays valid
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, expires_at), least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Metrics
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, size, expires_at = entry
+            if time.monotonic() > expires_at:
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        """Cache value under key, evicting least recently used entries as needed"""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + (ttl or self.ttl))
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        """Drop key from the cache, e.g. after its message was expunged"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        # Caller must hold the lock
+        value, size, expires_at = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        """Return a snapshot of cache size and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'backend': 'memory',
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations
+            }
+
+
+class DiskCache:
+    """
+    Cache stored in a SQLite file, shared by every process on the host.
+
+    Values must be JSON serializable; others are not cached and are counted
+    as errors. Eviction is least recently used by
+    total size, like MessageCache; access times are only written back once a
+    minute per entry so that hits stay read-only in the common case.
+
+    Args:
+        path (str): SQLite database file
+        max_bytes (int): Upper bound for the summed size of cached values
+        ttl (float): Seconds an entry stays valid
+    """
+
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, ttl=3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._errors = 0
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute('SELECT value, expires_at, accessed_at FROM cache WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or row[1] < now:
+            self._count('_misses')
+            return None
+        if now - row[2] > self.TOUCH_INTERVAL:
+            with conn:
+                conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+        self._count('_hits')
+        return json.loads(row[0])
+
+    def put(self, key, value, ttl=None):
+        try:
+            data = json.dumps(value).encode()
+        except (TypeError, ValueError) as e:
+            # An uncacheable value must not break the request
+            print(f"Cache error: {e}")
+            self._count('_errors')
+            return
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                         (key, data, len(data), now + (ttl or self.ttl), now))
+            conn.execute('DELETE FROM cache WHERE expires_at < ?', (now,))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+            if total > self.max_bytes:
+                # Drop least recently used entries until back under the limit
+                excess = total - self.max_bytes
+                victims = []
+                for victim, size in conn.execute('SELECT key, size FROM cache ORDER BY accessed_at'):
+                    victims.append((victim,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                conn.executemany('DELETE FROM cache WHERE key = ?', victims)
+                with self._stats_lock:
+                    self._evictions += len(victims)
+
+    def invalidate(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache')
+
+    def stats(self):
+        entries, size = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+        with self._stats_lock:
+            lookups = self._hits + self._misses
+            return {
+                'backend': 'disk',
+                'entries': entries,
+                'bytes': size,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0,
+                'evictions': self._evictions,
+                'errors': self._errors
+            }
+
+
+class RedisError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RedisClient:
+    """
+    Minimal thread-safe client for the Redis serialization protocol (RESP).
+
+    Only what the cache needs is used (GET, SET, DEL, INCR), so any
+    Redis-protocol server works, including KeyDB, Valkey and local fakes.
+
+    Args:
+        url (str): redis://[:password@]host[:port][/db]
+        timeout (float): Socket timeout in seconds
+    """
+
+    def __init__(self, url, timeout=5):
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.strip('/') or 0)
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = self._sock.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', self.db)
+
+    def _close(self):
+        try:
+            self._sock.close()
+        except Exception:
+            pass
+        self._sock = None
+        self._file = None
+
+    def _call(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f'${len(data)}\r\n'.encode() + data + b'\r\n')
+        self._sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('Redis connection closed')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            count = int(payload)
+            return None if count < 0 else [self._read_reply() for _ in range(count)]
+        raise RedisError(f'Unexpected reply: {line!r}')
+
+    def execute(self, *args):
+        """Send one command and return its reply, reconnecting once on a broken connection"""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._open()
+                    return self._call(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt:
+                        raise
+
+
+class RedisCache:
+    """
+    Cache stored on a Redis-protocol server, shared by every worker and host.
+
+    Values are JSON encoded and expire with the server-side TTL; size bounds
+    and eviction are left to the server (e.g. maxmemory with allkeys-lru).
+    clear() bumps a generation number that is part of every key, so old
+    entries become unreachable without scanning the keyspace.
+
+    Args:
+        url (str): redis://[:password@]host[:port][/db]
+        ttl (float): Seconds an entry stays valid
+        prefix (str): Namespace for all keys
+    """
+
+    # Seconds a worker trusts its copy of the generation number
+    GENERATION_REFRESH = 5
+
+    def __init__(self, url, ttl=3600, prefix='ghostinbox'):
+        self.client = RedisClient(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._generation = None
+        self._generation_checked = 0
+        self._stats_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def _key(self, key):
+        if time.monotonic() - self._generation_checked > self.GENERATION_REFRESH:
+            generation = self.client.execute('GET', f'{self.prefix}:generation') or b'0'
+            self._generation = generation.decode()
+            self._generation_checked = time.monotonic()
+        return f'{self.prefix}:{self._generation}:{key}'
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        try:
+            data = self.client.execute('GET', self._key(key))
+        except (OSError, ConnectionError, RedisError) as e:
+            # An unavailable cache must not break the request
+            print(f"Cache error: {e}")
+            self._count('_errors')
+            return None
+        if data is None:
+            self._count('_misses')
+            return None
+        self._count('_hits')
+        return json.loads(data)
+
+    def put(self, key, value, ttl=None):
+        try:
+            self.client.execute('SET', self._key(key), json.dumps(value), 'EX', int(ttl or self.ttl))
+        except (OSError, ConnectionError, RedisError, TypeError, ValueError) as e:
+            print(f"Cache error: {e}")
+            self._count('_errors')
+
+    def invalidate(self, key):
+        try:
+            self.client.execute('DEL', self._key(key))
+        except (OSError, ConnectionError, RedisError) as e:
+            print(f"Cache error: {e}")
+            self._count('_errors')
+
+    def clear(self):
+        try:
+            self._generation = str(self.client.execute('INCR', f'{self.prefix}:generation'))
+        except (OSError, ConnectionError, RedisError) as e:
+            print(f"Cache error: {e}")
+            self._count('_errors')
+            return
+        self._generation_checked = time.monotonic()
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self._hits + self._misses
+            return {
+                'backend': 'redis',
+                'server': f'{self.client.host}:{self.client.port}/{self.client.db}',
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0,
+                'errors': self._errors
+            }
+
+
+def create_cache(backend='memory', path=None, url=None, max_bytes=64 * 1024 * 1024, ttl=3600):
+    """
+    Build the cache selected in configuration.
+
+    Args:
+        backend (str): "memory" (per process), "disk" (per host) or "redis" (shared)
+        path (str): SQLite file for the disk backend
+        url (str): Server URL for the redis backend
+        max_bytes (int): Size bound for the memory and disk backends
+        ttl (float): Default seconds an entry stays valid
+
+    Returns:
+        object: Cache with get/put/invalidate/clear/stats
+    """
+    if backend == 'memory':
+        return MessageCache(max_bytes=max_bytes, ttl=ttl)
+    if backend == 'disk':
+        return DiskCache(path or 'ghostinbox_cache.sqlite3', max_bytes=max_bytes, ttl=ttl)
+    if backend == 'redis':
+        return RedisCache(url or 'redis://localhost:6379/0', ttl=ttl)
+    raise ValueError(f'Unknown cache backend: {backend}')
@@ -0,0 +1,173 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+# Upper bounds in days of the recent and older age buckets; the rest is very old
+AGE_BUCKETS = (7, 30)
+
+
+def age_buckets(received, now, bounds=AGE_BUCKETS):
+    """
+    Count emails per age bucket in one pass over a column of arrival timestamps.
+
+    The column is sorted once and each bucket boundary is found by bisection,
+    instead of computing and branching on the age of every email.
+
+    Args:
+        received (iterable): Arrival timestamps, None or 0 for unknown dates
+        now (float): Reference timestamp
+        bounds (tuple): Inclusive upper bounds, in whole days, of all buckets but the last
+
+    Returns:
+        list: Email counts per bucket, youngest first; unknown dates are not counted
+    """
+    column = sorted(filter(None, received))
+    # An email is at most n whole days old when it arrived after now - (n + 1) days
+    younger = [len(column) - bisect_right(column, now - (days + 1) * 86400) for days in bounds]
+    counts = []
+    previous = 0
+    for count in younger + [len(column)]:
+        counts.append(count - previous)
+        previous = count
+    return counts
+
+
+class MetadataColumns:
+    """
+    Metadata of every email in a mailbox, held as parallel typed columns.
+
+    Rows are kept in UID order. UIDs, arrival times and sizes live in
+    array.array columns, and senders and receivers as ids into one table of
+    interned addresses. Totals, histograms and top-N lists are then
+    reductions over a column rather than walks over per-message dicts, and
+    a row costs a few dozen bytes plus its subject.
+    """
+
+    def __init__(self):
+        self.uids = array('Q')
+        self.received = array('d')   # UNIX timestamps, 0 when unknown
+        self.sizes = array('Q')
+        self.senders = array('L')
+        self.receivers = array('L')
+        self.subjects = []
+        self.names = []
+        self._name_ids = {}
+
+    def __len__(self):
+        return len(self.uids)
+
+    def _intern(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def add(self, uid, received, size, sender, receiver, subject):
+        """
+        Add or replace the row of one email.
+
+        New mail has the highest UIDs, so rows are normally appended.
+        """
+        position = bisect_left(self.uids, uid)
+        if position < len(self.uids) and self.uids[position] == uid:
+            self.remove([uid])
+        values = (uid, received or 0.0, size, self._intern(sender), self._intern(receiver))
+        columns = (self.uids, self.received, self.sizes, self.senders, self.receivers)
+        if position == len(self.uids):
+            for column, value in zip(columns, values):
+                column.append(value)
+            self.subjects.append(subject)
+        else:
+            for column, value in zip(columns, values):
+                column.insert(position, value)
+            self.subjects.insert(position, subject)
+
+    def row(self, position):
+        """Return (uid, received, size, sender, receiver, subject) of the row at position"""
+        return (self.uids[position], self.received[position] or None, self.sizes[position],
+                self.names[self.senders[position]], self.names[self.receivers[position]],
+                self.subjects[position])
+
+    def remove(self, uids):
+        """
+        Drop the rows of some emails, rebuilding each column once.
+
+        Args:
+            uids (iterable): UIDs to drop; unknown ones are ignored
+
+        Returns:
+            list: Rows removed, as returned by row()
+        """
+        uids = set(uids)
+        drop = [position for position, uid in enumerate(self.uids) if uid in uids]
+        if not drop:
+            return []
+        removed = [self.row(position) for position in drop]
+        dropped = set(drop)
+        keep = [position for position in range(len(self.uids)) if position not in dropped]
+        for name in ('uids', 'received', 'sizes', 'senders', 'receivers'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[position] for position in keep]))
+        self.subjects = [self.subjects[position] for position in keep]
+        return removed
+
+    def retain(self, uids):
+        """Drop every row whose UID is not in uids, returning the removed rows"""
+        uids = set(uids)
+        return self.remove([uid for uid in self.uids if uid not in uids])
+
+    def newest(self, count):
+        """Return the rows of the count highest UIDs, newest first"""
+        return [self.row(position) for position in range(len(self.uids) - 1, max(len(self.uids) - count, 0) - 1, -1)]
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def largest_size(self):
+        return max(self.sizes, default=0)
+
+    def age_histogram(self, now, bounds=AGE_BUCKETS):
+        return age_buckets(self.received, now, bounds)
+
+    def counts(self, column):
+        """
+        Emails per address in the senders or receivers column.
+
+        Counted over the interned ids, then keyed by address so counts of
+        several stores can be added up.
+
+        Returns:
+            Counter: address -> number of emails
+        """
+        return Counter({self.names[name_id]: emails for name_id, emails in Counter(getattr(self, column)).items()})
+
+    def to_dict(self):
+        """Serialize the columns to JSON-compatible lists, dropping unused addresses"""
+        used = sorted(set(self.senders) | set(self.receivers))
+        remap = {name_id: new_id for new_id, name_id in enumerate(used)}
+        return {
+            'uids': self.uids.tolist(),
+            'received': self.received.tolist(),
+            'sizes': self.sizes.tolist(),
+            'senders': [remap[name_id] for name_id in self.senders],
+            'receivers': [remap[name_id] for name_id in self.receivers],
+            'subjects': self.subjects,
+            'names': [self.names[name_id] for name_id in used]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        columns = cls()
+        columns.uids = array('Q', data['uids'])
+        columns.received = array('d', data['received'])
+        columns.sizes = array('Q', data['sizes'])
+        columns.senders = array('L', data['senders'])
+        columns.receivers = array('L', data['receivers'])
+        columns.subjects = list(data['subjects'])
+        columns.names = list(data['names'])
+        columns._name_ids = {name: name_id for name_id, name in enumerate(columns.names)}
+        if not (len(columns.uids) == len(columns.received) == len(columns.sizes) == len(columns.senders)
+                == len(columns.receivers) == len(columns.subjects)):
+            raise ValueError('Columns of different lengths')
+        return columns
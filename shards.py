@@ -0,0 +1,98 @@
+import imaplib
+import os
+
+DEFAULT_IMAP_SERVER = 'imapmail.libero.it'
+
+# Hex digits of the alias hash that pick its shard
+SHARD_PREFIX_LENGTH = 4
+
+
+class Shard:
+    """
+    One backing mailbox holding the emails of a slice of the alias hashes.
+
+    A shard is an account, a folder in an account, or both. Each gets a
+    contiguous range of hash prefixes (see shard_index()), so the forwarding
+    rules delivering mail to it can be written as prefix ranges too.
+    """
+
+    def __init__(self, number, user, password, server=DEFAULT_IMAP_SERVER, mailbox='INBOX', port=993):
+        self.number = number
+        self.user = user
+        self.password = password
+        self.server = server
+        self.mailbox = mailbox
+        self.port = port
+
+    @property
+    def account(self):
+        """Key of the account, shared by folder shards of the same account"""
+        return f'{self.user}@{self.server}'
+
+    @property
+    def name(self):
+        return f'{self.user}/{self.mailbox}'
+
+    def connect(self):
+        """Open a logged-in IMAP connection to the shard's account (no mailbox selected)"""
+        mail = imaplib.IMAP4_SSL(self.server, self.port)
+        mail.login(self.user, self.password)
+        return mail
+
+    def path(self, path, count):
+        """Suffix a per-mailbox state file with the shard number when there are several shards"""
+        if count <= 1:
+            return path
+        base, extension = os.path.splitext(path)
+        return f'{base}.shard{self.number}{extension}'
+
+    def __repr__(self):
+        return f'Shard({self.number}, {self.name!r})'
+
+
+def load_shards(environ=os.environ):
+    """
+    Read the backing mailboxes from the environment.
+
+    MAILBOX_SHARDS=N enables N shards, configured with SHARD_<i>_EMAIL,
+    SHARD_<i>_PASSWORD, SHARD_<i>_SERVER and SHARD_<i>_MAILBOX (i from 0).
+    Unset values fall back to BASE_EMAIL, BASE_PASSWORD, the Libero server
+    and INBOX, so folder shards of one account only need SHARD_<i>_MAILBOX.
+    Without MAILBOX_SHARDS the only shard is the inbox of BASE_EMAIL.
+
+    Returns:
+        list: Shard objects, in shard number order
+    """
+    count = int(environ.get('MAILBOX_SHARDS') or 1)
+    if count < 1:
+        raise ValueError('MAILBOX_SHARDS must be at least 1')
+    shards = []
+    for number in range(count):
+        prefix = f'SHARD_{number}_'
+        shards.append(Shard(
+            number,
+            environ.get(prefix + 'EMAIL') or environ.get('BASE_EMAIL'),
+            environ.get(prefix + 'PASSWORD') or environ.get('BASE_PASSWORD'),
+            server=environ.get(prefix + 'SERVER') or DEFAULT_IMAP_SERVER,
+            mailbox=environ.get(prefix + 'MAILBOX') or 'INBOX',
+        ))
+    if len({(shard.account, shard.mailbox.upper()) for shard in shards}) < len(shards):
+        raise ValueError('Two shards use the same mailbox')
+    return shards
+
+
+def shard_index(hash, count):
+    """
+    Map an alias hash to a shard number.
+
+    The first SHARD_PREFIX_LENGTH hex digits are split into count contiguous
+    ranges, e.g. 0000-7fff and 8000-ffff for two shards.
+
+    Args:
+        hash (str): sha256 hex digest of the alias
+        count (int): Number of shards
+
+    Returns:
+        int: Shard number, from 0 to count - 1
+    """
+    return int(hash[:SHARD_PREFIX_LENGTH], 16) * count >> (4 * SHARD_PREFIX_LENGTH)
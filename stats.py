@@ -1,11 +1,7 @@
 from datetime import datetime
-import imaplib
-import email
-from email.header import decode_header
 import os
 from dotenv import load_dotenv
-from collections import Counter
-import re
+from maintenance import SHARDS, run_sharded_maintenance
 
 # Load environment variables
 load_dotenv()
@@ -15,170 +11,26 @@ EMAIL_ADDRESS = os.getenv('BASE_EMAIL')
 PASSWORD = os.getenv('BASE_PASSWORD')
 IMAP_SERVER = 'imapmail.libero.it'
 
-def extract_email_from_to_field(to_field):
-    """Extract email address from the 'to' field"""
-    if not to_field:
-        return None
-    email_pattern = r'<([^>]+)>|([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})'
-    match = re.search(email_pattern, to_field)
-    if match:
-        return match.group(1) if match.group(1) else match.group(2)
-    return None
-
 def get_web_stats():
     """Get comprehensive email statistics for web display"""
     try:
-        print(f"🔗 Connecting to IMAP server: {IMAP_SERVER}")
-        # Connect to IMAP server
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
-        mail.login(EMAIL_ADDRESS, PASSWORD)
-        mail.select('inbox')
-
-        # Search for all emails
-        status, data = mail.search(None, 'ALL')
-        email_ids = data[0].split()
-        print(f"📧 Found {len(email_ids)} total emails in inbox")
-
-        # Statistics tracking
-        total_emails = 0
-        unique_senders = set()
-        unique_receivers = set()
-        deleted_count = 0
-        total_size = 0
-        largest_email_size = 0
-        recent_emails = 0
-        older_emails = 0
-        very_old_emails = 0
-        
-        # Counters for top senders/receivers
-        sender_counter = Counter()
-        receiver_counter = Counter()
-        
-        # Recent emails list for display
-        recent_emails_list = []
-        
+        print(f"🔗 Connecting to {len(SHARDS)} mailbox(es) on IMAP server: {IMAP_SERVER}")
         print(f"🔍 Starting email analysis...")
-        ghostinbox_emails = 0
-
-        for email_id in email_ids:
-            # Fetch email
-            status, msg_data = mail.fetch(email_id, '(RFC822)')
-            msg = email.message_from_bytes(msg_data[0][1])
-
-            # Get email details
-            from_ = msg.get('from', 'Unknown')
-            to_ = msg.get('to', 'Unknown')
-            
-            # Extract plain email addresses for display/counters
-            from_email = extract_email_from_to_field(from_) or from_
-            
-            # Extract email from 'to' field and check if it's ghostinbox.it
-            extracted_email = extract_email_from_to_field(to_)
-            if not extracted_email or not extracted_email.lower().endswith('@ghostinbox.it'):
-                # Delete emails that don't end with @ghostinbox.it
-                mail.store(email_id, '+FLAGS', '\\Deleted')
-                print(f"🗑️  Deleting non-ghostinbox email: {extracted_email or 'unknown'}")
-                continue  # Skip processing but mark for deletion
-            
-            ghostinbox_emails += 1
-            total_emails += 1
-            
-            # Update counters
-            unique_senders.add(from_email)
-            unique_receivers.add(extracted_email)
-            sender_counter[from_email] += 1
-            receiver_counter[extracted_email] += 1
-            
-            # Get subject
-            subject, encoding = decode_header(msg['subject'])[0] if msg['subject'] else ('No Subject', None)
-            if isinstance(subject, bytes):
-                subject = subject.decode(encoding or 'utf-8', errors='ignore')
-
-            # Calculate age in days
-            date_str = msg.get('date')
-            age_days = 'N/A'
-            if date_str:
-                try:
-                    email_date = datetime.strptime(date_str, '%a, %d %b %Y %H:%M:%S %z')
-                    age_days = (datetime.now(email_date.tzinfo) - email_date).days
-                except ValueError:
-                    age_days = 'N/A'
-
-            # Calculate size
-            size = len(msg_data[0][1])
-            total_size += size
-            largest_email_size = max(largest_email_size, size)
-
-            # Categorize by age
-            if isinstance(age_days, int):
-                if age_days <= 7:
-                    recent_emails += 1
-                elif age_days <= 30:
-                    older_emails += 1
-                else:
-                    very_old_emails += 1
-
-            # Check if email should be deleted
-            status = 'Kept'
-            if isinstance(age_days, int) and age_days > 30:
-                mail.store(email_id, '+FLAGS', '\\Deleted')
-                status = 'Deleted'
-                deleted_count += 1
-
-            # Add to recent emails list (last 10)
-            if len(recent_emails_list) < 10:
-                recent_emails_list.append({
-                    'from_': from_email,
-                    'to_': extracted_email,  # Use extracted email instead of raw 'to' field
-                    'subject': subject,
-                    'age_days': age_days,
-                    'size_kb': round(size / 1024, 1),
-                    'status': status
-                })
-
-        # Permanently remove deleted emails
-        mail.expunge()
-        mail.logout()
+        # Every shard is scanned at once, over its own connection
+        stats = run_sharded_maintenance()
 
         print(f"✅ Email analysis complete!")
         print(f"📊 Statistics Summary:")
-        print(f"   • Total ghostinbox.it emails: {ghostinbox_emails}")
-        print(f"   • Non-ghostinbox emails deleted: {len(email_ids) - ghostinbox_emails}")
-        print(f"   • Unique senders: {len(unique_senders)}")
-        print(f"   • Unique receivers: {len(unique_receivers)}")
-        print(f"   • Deleted old emails: {deleted_count}")
-        print(f"   • Total size: {round(total_size / (1024 * 1024), 1)} MB")
-        print(f"   • Recent emails (0-7 days): {recent_emails}")
-        print(f"   • Older emails (8-30 days): {older_emails}")
-        print(f"   • Very old emails (30+ days): {very_old_emails}")
-
-        # Prepare top senders and receivers
-        top_senders = [{'email': email, 'count': count} for email, count in sender_counter.most_common(5)]
-        top_receivers = [{'email': email, 'count': count} for email, count in receiver_counter.most_common(5)]
-
-        # Calculate averages
-        avg_size_kb = round(total_size / total_emails / 1024, 1) if total_emails > 0 else 0
-        total_size_mb = round(total_size / (1024 * 1024), 1)
-        largest_email_kb = round(largest_email_size / 1024, 1)
-
-        return {
-            'total_emails': total_emails,
-            'unique_senders': len(unique_senders),
-            'unique_receivers': len(unique_receivers),
-            'deleted_count': deleted_count,
-            'total_size_mb': total_size_mb,
-            'avg_size_kb': avg_size_kb,
-            'largest_email_kb': largest_email_kb,
-            'recent_emails': recent_emails,
-            'older_emails': older_emails,
-            'very_old_emails': very_old_emails,
-            'recent_emails_list': recent_emails_list,
-            'top_senders': top_senders,
-            'top_receivers': top_receivers,
-            'imap_server': IMAP_SERVER,
-            'email_account': EMAIL_ADDRESS,
-            'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
+        print(f"   • Total ghostinbox.it emails: {stats['total_emails']}")
+        print(f"   • Non-ghostinbox emails deleted: {stats['non_ghostinbox_deleted']}")
+        print(f"   • Unique senders: {stats['unique_senders']}")
+        print(f"   • Unique receivers: {stats['unique_receivers']}")
+        print(f"   • Deleted old emails: {stats['deleted_count']}")
+        print(f"   • Total size: {stats['total_size_mb']} MB")
+        print(f"   • Recent emails (0-7 days): {stats['recent_emails']}")
+        print(f"   • Older emails (8-30 days): {stats['older_emails']}")
+        print(f"   • Very old emails (30+ days): {stats['very_old_emails']}")
+        return stats
 
     except Exception as e:
         print(f"❌ Error getting web stats: {e}")
@@ -206,10 +58,16 @@ def get_web_stats():
             'error': str(e)
         }
 
-def generate_static_stats_page():
-    """Generate a static HTML stats page and save it to static folder"""
+def generate_static_stats_page(stats=None):
+    """
+    Generate a static HTML stats page and save it to static folder
+
+    Args:
+        stats (dict): Statistics from a maintenance run; one is made when omitted
+    """
     print(f"🚀 Starting static stats page generation...")
-    stats = get_web_stats()
+    if stats is None:
+        stats = get_web_stats()
     
     # Generate the HTML content
     html_content = f'''<!DOCTYPE html>
@@ -0,0 +1,134 @@
+import html
+import unittest
+
+from email_render import render_body, sanitize_html
+
+
+class SanitizeHtmlTest(unittest.TestCase):
+    """Payloads the sanitizer must neutralize, and formatting it must keep"""
+
+    def sanitize(self, body):
+        return sanitize_html(body)[0]
+
+    def test_script_removed_with_content(self):
+        self.assertEqual(self.sanitize('<p>hi<script>alert(1)</script></p>'), '<p>hi</p>')
+
+    def test_unclosed_script_drops_rest(self):
+        self.assertEqual(self.sanitize('<p>hi</p><script>alert(1)'), '<p>hi</p>')
+
+    def test_style_and_iframe_removed(self):
+        result = self.sanitize('<style>body{display:none}</style><iframe src="https://x.test"></iframe>ok')
+        self.assertEqual(result, 'ok')
+
+    def test_svg_removed(self):
+        self.assertEqual(self.sanitize('<svg><script>alert(1)</script></svg>ok'), 'ok')
+
+    def test_void_dropped_tags_keep_the_rest(self):
+        for tag in ('embed src="x.swf"', 'frame src="https://x.test"', 'param name="a" value="b"',
+                    'source src="x.mp4"', 'track src="x.vtt"', 'embed src="x.swf" /'):
+            with self.subTest(tag=tag):
+                self.assertEqual(self.sanitize(f'<p>a<{tag}>b</p><p>rest</p>'), '<p>ab</p><p>rest</p>')
+
+    def test_void_tags_inside_dropped_tags(self):
+        result = self.sanitize('<video><source src="x.mp4"><track src="x.vtt"></video><frameset><frame></frameset>ok')
+        self.assertEqual(result, 'ok')
+
+    def test_event_handlers_dropped(self):
+        result = self.sanitize('<div onclick="alert(1)" onmouseover="alert(2)">x</div>')
+        self.assertEqual(result, '<div>x</div>')
+
+    def test_javascript_link_dropped(self):
+        self.assertEqual(self.sanitize('<a href="javascript:alert(1)">x</a>'), '<a>x</a>')
+
+    def test_obfuscated_javascript_link_dropped(self):
+        for href in ('JaVaScRiPt:alert(1)', ' javascript:alert(1)', 'java\tscript:alert(1)',
+                     'java&#x09;script:alert(1)', 'data:text/html,<script>alert(1)</script>'):
+            with self.subTest(href=href):
+                self.assertNotIn('href', self.sanitize(f'<a href="{href}">x</a>'))
+
+    def test_http_link_opens_without_referrer(self):
+        self.assertEqual(
+            self.sanitize('<a href="https://example.com/">x</a>'),
+            '<a href="https://example.com/" target="_blank" rel="noopener noreferrer nofollow">x</a>'
+        )
+
+    def test_remote_image_blocked(self):
+        result, blocked = sanitize_html('<img src="https://tracker.test/p.gif">')
+        self.assertEqual(result, '<img data-blocked-src="https://tracker.test/p.gif">')
+        self.assertEqual(blocked, 1)
+
+    def test_inline_image_kept(self):
+        body = '<img src="data:image/png;base64,iVBORw0KGgo=">'
+        self.assertEqual(sanitize_html(body), (body, 0))
+
+    def test_attribute_breakout_escaped(self):
+        result = self.sanitize('<p title=\'"><script>alert(1)</script>\'>x</p>')
+        self.assertEqual(result, '<p title="&quot;&gt;&lt;script&gt;alert(1)&lt;/script&gt;">x</p>')
+
+    def test_style_url_blocked(self):
+        result, blocked = sanitize_html('<td style="background: url(https://tracker.test/p.gif); color: red">x</td>')
+        self.assertEqual(result, '<td style="color: red">x</td>')
+        self.assertEqual(blocked, 1)
+
+    def test_style_image_functions_blocked(self):
+        for style in ("background: image-set('https://tracker.test/p.png' 1x)",
+                      "background-image: -webkit-image-set('https://tracker.test/p.png' 1x, 'https://tracker.test/q.png' 2x)",
+                      "background: image('https://tracker.test/p.png')",
+                      "background: cross-fade('https://tracker.test/a.png', 'https://tracker.test/b.png', 50%)",
+                      "background: -moz-element(#tracker)",
+                      "background: src('https://tracker.test/p.png')"):
+            with self.subTest(style=style):
+                result, blocked = sanitize_html(f'<td style="{html.escape(style)}; color: red">x</td>')
+                self.assertEqual(result, '<td style="color: red">x</td>')
+                self.assertEqual(blocked, 1)
+
+    def test_style_expression_and_escapes_dropped(self):
+        for style in ('width: expression(alert(1))', 'behavior: url(x.htc)', 'color: red; -moz-binding: url(x)',
+                      'background: \\75 rl(https://tracker.test/p.gif)'):
+            with self.subTest(style=style):
+                self.assertNotIn('(', self.sanitize(f'<p style="{style}">x</p>'))
+
+    def test_fixed_overlay_dropped(self):
+        result = self.sanitize(
+            '<div style="position: fixed; top: 0; left: 0; z-index: 2147483647; width: 100%; '
+            'height: 100%; background-color: white">Your session expired, log in again</div>'
+        )
+        self.assertEqual(
+            result,
+            '<div style="width: 100%; height: 100%; background-color: white">Your session expired, log in again</div>'
+        )
+
+    def test_positioning_properties_dropped(self):
+        for style in ('position: absolute', 'position: sticky', 'z-index: 10', 'top: -100px',
+                      'transform: translate(-500px, -500px)', 'posit\\ion: fixed'):
+            with self.subTest(style=style):
+                self.assertEqual(self.sanitize(f'<p style="{style}">x</p>'), '<p>x</p>')
+
+    def test_negative_margins_dropped(self):
+        for style in ('margin-top: -300px', 'margin: 0 -50%', 'margin-left: calc(0px - 200px)', 'margin: -.5em'):
+            with self.subTest(style=style):
+                self.assertEqual(self.sanitize(f'<p style="{style}">x</p>'), '<p>x</p>')
+
+    def test_formatting_styles_kept(self):
+        result = self.sanitize('<p style="COLOR: #333; margin: 0 auto; padding: 4px 8px; font-weight: bold">x</p>')
+        self.assertEqual(result, '<p style="color: #333; margin: 0 auto; padding: 4px 8px; font-weight: bold">x</p>')
+
+    def test_unclosed_tags_closed(self):
+        self.assertEqual(self.sanitize('<div><b>x'), '<div><b>x</b></div>')
+
+
+class RenderBodyTest(unittest.TestCase):
+
+    def test_plain_text_escaped(self):
+        rendered = render_body('<script>alert(1)</script>', 'text/plain')
+        self.assertEqual(rendered['html'], '&lt;script&gt;alert(1)&lt;/script&gt;')
+
+    def test_digest_depends_on_input(self):
+        self.assertEqual(render_body('x', 'text/html')['digest'], render_body('x', 'text/html')['digest'])
+        self.assertNotEqual(render_body('x', 'text/html')['digest'], render_body('x', 'text/plain')['digest'])
+        self.assertNotEqual(render_body('x', 'text/html')['digest'],
+                            render_body('x', 'text/html', truncated=True)['digest'])
+
+
+if __name__ == '__main__':
+    unittest.main()
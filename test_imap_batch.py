@@ -0,0 +1,53 @@
+import unittest
+
+from imap_batch import merge_uid_items, parse_fetch_response, quote_mailbox, to_sequence_set
+
+
+class ParseFetchResponseTest(unittest.TestCase):
+
+    def parse(self, data):
+        return list(parse_fetch_response(data))
+
+    def test_literal(self):
+        data = [(b'1 (UID 5 BODY[1] {5}', b'hello'), b')']
+        self.assertEqual(self.parse(data), [(1, {'UID': b'5', 'BODY[1]': b'hello'})])
+
+    def test_literal8(self):
+        data = [(b'1 (UID 5 BINARY[1]<0> ~{3}', b'a\x00b'), b')']
+        self.assertEqual(self.parse(data), [(1, {'UID': b'5', 'BINARY[1]<0>': b'a\x00b'})])
+
+    def test_literal8_followed_by_items(self):
+        data = [(b'1 (BINARY[2] ~{4}', b'\x00\x01\r\n'), b' UID 9 BINARY.SIZE[2] 4)']
+        self.assertEqual(self.parse(data), [(1, {'BINARY[2]': b'\x00\x01\r\n', 'UID': b'9', 'BINARY.SIZE[2]': b'4'})])
+
+    def test_empty_literal8(self):
+        data = [(b'3 (UID 7 BINARY[1] ~{0}', b''), b')']
+        self.assertEqual(self.parse(data), [(3, {'UID': b'7', 'BINARY[1]': b''})])
+
+    def test_several_messages(self):
+        data = [(b'1 (UID 5 BINARY[1] ~{1}', b'\x00'), b')', (b'2 (UID 6 BINARY[1] {1}', b'x'), b')']
+        self.assertEqual(self.parse(data), [(1, {'UID': b'5', 'BINARY[1]': b'\x00'}),
+                                            (2, {'UID': b'6', 'BINARY[1]': b'x'})])
+
+    def test_quoted_string_and_nil(self):
+        data = [b'4 (UID 8 FLAGS (\\Seen) ENVELOPE ("a \\"b\\"" NIL))']
+        self.assertEqual(self.parse(data), [(4, {'UID': b'8', 'FLAGS': [b'\\Seen'], 'ENVELOPE': [b'a "b"', None]})])
+
+
+class HelpersTest(unittest.TestCase):
+
+    def test_merge_uid_items_keeps_requested_uids(self):
+        responses = [(1, {'UID': b'5', 'FLAGS': []}), (2, {'UID': b'9'}), (1, {'UID': b'5', 'BODY[]': b'x'})]
+        self.assertEqual(list(merge_uid_items(responses, [5])), [(5, {'UID': b'5', 'FLAGS': [], 'BODY[]': b'x'})])
+
+    def test_to_sequence_set(self):
+        self.assertEqual(to_sequence_set([5, 1, 2, 3, 9, 10]), '1:3,5,9:10')
+
+    def test_quote_mailbox(self):
+        self.assertEqual(quote_mailbox('Shard 1'), '"Shard 1"')
+        self.assertEqual(quote_mailbox('a"b\\c'), '"a\\"b\\\\c"')
+        self.assertEqual(quote_mailbox('"INBOX"'), '"INBOX"')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import hashlib
+import imaplib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import imap_batch
+import mail_index
+from mail_index import IndexNotifier, MailIndex
+
+
+def hash_address(alias):
+    return hashlib.sha256(alias.encode()).hexdigest()
+
+
+def headers(to, subject=b'hello', sender=b'alice@example.com'):
+    return (b'From: ' + sender + b'\r\nTo: ' + to.encode() + b'\r\nSubject: ' + subject +
+            b'\r\nDate: Tue, 28 Oct 2025 10:00:00 +0000\r\n\r\n')
+
+
+class StubIMAP:
+    """Just enough of imaplib.IMAP4 for MailIndex.sync(), answering from a dict of UID -> headers"""
+
+    error = imaplib.IMAP4.error
+
+    def __init__(self, messages, fail_fetch=None):
+        self.messages = messages
+        self.fail_fetch = fail_fetch
+
+    def status(self, mailbox, items):
+        uidnext = max(self.messages, default=0) + 1
+        return 'OK', [f'{mailbox} (MESSAGES {len(self.messages)} UIDNEXT {uidnext} UIDVALIDITY 7)'.encode()]
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            return 'OK', [' '.join(str(uid) for uid in sorted(self.messages)).encode()]
+        uids = [int(uid) for uid in args[0].split(',') for uid in self._range(uid)]
+        if self.fail_fetch and self.fail_fetch in uids:
+            return 'NO', [b'fetch failed']
+        data = []
+        for uid in uids:
+            raw = self.messages[uid]
+            data.append((f'{uid} (UID {uid} FLAGS (\\Seen) RFC822.SIZE {len(raw)} '
+                         f'BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {{{len(raw)}}}'.encode(), raw))
+            data.append(b')')
+        return 'OK', data
+
+    def _range(self, part):
+        start, _, end = part.partition(':')
+        return [str(uid) for uid in range(int(start), int(end or start) + 1) if uid in self.messages]
+
+
+class MailIndexSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index = MailIndex(os.path.join(self.tmp.name, 'index.sqlite3'))
+        self.hash = hash_address('myalias123')
+        self.to = f'{self.hash}@ghostinbox.it'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_raw_8bit_headers_are_indexed(self):
+        mail = StubIMAP({
+            1: headers(self.to, subject=b'Gr\xfc\xdfe', sender=b'J\xc3\xb6rg <j@example.de>'),
+            2: headers(self.to, subject=b'=?utf-8?q?J=C3=BCrgen?=')
+        })
+        result = self.index.sync(mail)
+        self.assertEqual(result['added'], 2)
+        emails = self.index.search(self.hash)
+        self.assertEqual([email['id'] for email in emails], ['2', '1'])
+        self.assertEqual(emails[0]['subject'], 'Jürgen')
+        self.assertEqual(emails[1]['from'], 'Jörg <j@example.de>')
+        self.assertEqual(emails[1]['subject'], 'Gr��e')
+        for email in emails:
+            for field in ('from', 'to', 'subject', 'date'):
+                self.assertIsInstance(email[field], str)
+
+    def test_unreadable_message_does_not_stop_the_batch(self):
+        mail = StubIMAP({uid: headers(self.to, subject=f's{uid}'.encode()) for uid in (1, 2, 3)})
+        real = mail_index.recipient_hashes
+
+        def failing(items, domain):
+            if items.get('UID') == b'2':
+                raise ValueError('broken')
+            return real(items, domain)
+
+        with mock.patch.object(mail_index, 'recipient_hashes', failing):
+            self.index.sync(mail)
+        self.assertEqual([email['id'] for email in self.index.search(self.hash)], ['3', '1'])
+        self.assertEqual(self.index.stats()['uidnext'], 4)
+
+    def test_failed_round_keeps_stored_batches(self):
+        mail = StubIMAP({uid: headers(self.to) for uid in range(1, 6)}, fail_fetch=5)
+        with mock.patch.object(mail_index, 'FETCH_CHUNK_SIZE', 2), \
+                mock.patch.object(imap_batch, 'FETCH_CHUNK_SIZE', 2):
+            with self.assertRaises(imaplib.IMAP4.error):
+                self.index.sync(mail)
+            self.assertEqual(self.index.stats()['uidnext'], 5)
+            self.assertEqual(len(self.index.search(self.hash)), 4)
+
+            mail.fail_fetch = None
+            self.assertEqual(self.index.sync(mail)['added'], 1)
+        self.assertEqual(len(self.index.search(self.hash)), 5)
+
+
+class ExpungeTest(unittest.TestCase):
+    """Two MailIndex objects on one file stand for the sync leader and another worker process"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'index.sqlite3')
+        self.leader = MailIndex(path)
+        self.worker = MailIndex(path)
+        self.hash = hash_address('myalias123')
+        self.mail = StubIMAP({uid: headers(f'{self.hash}@ghostinbox.it') for uid in (1, 2, 3)})
+        self.leader.sync(self.mail)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_every_process_applies_expunges(self):
+        self.assertTrue(self.worker.owns(self.hash, 2))
+        removed = []
+        notifier = IndexNotifier(self.worker, on_expunge=removed.extend)
+        notifier._check()
+
+        del self.mail.messages[2]
+        self.assertEqual(self.leader.sync(self.mail)['removed_uids'], [2])
+        notifier._check()
+        self.assertEqual(removed, [2])
+        self.assertFalse(self.worker.owns(self.hash, 2))
+        self.assertTrue(self.worker.owns(self.hash, 3))
+
+        # Already applied: nothing is reported twice
+        notifier._check()
+        self.assertEqual(removed, [2])
+        self.assertEqual(self.leader.apply_expunged(), [2])
+
+    def test_rebuild_forgets_expunged(self):
+        del self.mail.messages[1]
+        self.leader.sync(self.mail)
+        self.mail.status = lambda mailbox, items: ('OK', [b'INBOX (MESSAGES 2 UIDNEXT 4 UIDVALIDITY 8)'])
+        self.leader.sync(self.mail)
+        self.assertEqual(self.worker.apply_expunged(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
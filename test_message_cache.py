@@ -0,0 +1,200 @@
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import unittest
+from email.header import Header
+
+from message_cache import DiskCache, MessageCache, RedisCache, RedisClient, RedisError
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Speaks enough RESP for RedisClient: AUTH, SELECT, GET, SET ... EX, DEL and INCR"""
+
+    def handle(self):
+        while True:
+            command = self._read_command()
+            if command is None:
+                return
+            self.wfile.write(self.server.fake.reply(command))
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, password=None):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.fake = self
+        self.password = password
+        self.data = {}
+        self.commands = []
+        self.fail = None
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        auth = f':{self.password}@' if self.password else ''
+        return f'redis://{auth}127.0.0.1:{self.server_address[1]}/2'
+
+    def reply(self, args):
+        name = args[0].decode().upper()
+        with self._lock:
+            self.commands.append(name)
+            if self.fail:
+                return f'-ERR {self.fail}\r\n'.encode()
+            if name == 'AUTH':
+                return b'+OK\r\n' if args[1].decode() == self.password else b'-WRONGPASS invalid password\r\n'
+            if name == 'SELECT':
+                return b'+OK\r\n'
+            if name == 'GET':
+                value = self.data.get(args[1])
+                return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+            if name == 'SET':
+                self.data[args[1]] = args[2]
+                return b'+OK\r\n'
+            if name == 'DEL':
+                return b':%d\r\n' % int(self.data.pop(args[1], None) is not None)
+            if name == 'INCR':
+                value = int(self.data.get(args[1], b'0')) + 1
+                self.data[args[1]] = str(value).encode()
+                return b':%d\r\n' % value
+            return f'-ERR unknown command {name}\r\n'.encode()
+
+
+class RedisClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeRedis(password='secret')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_replies(self):
+        client = RedisClient(self.server.url)
+        self.assertIsNone(client.execute('GET', 'missing'))
+        self.assertEqual(client.execute('SET', 'k', 'v\r\nwith newline'), 'OK')
+        self.assertEqual(client.execute('GET', 'k'), b'v\r\nwith newline')
+        self.assertEqual(client.execute('INCR', 'n'), 1)
+        self.assertEqual(client.execute('DEL', 'k'), 1)
+        self.assertEqual(self.server.commands[:2], ['AUTH', 'SELECT'])
+
+    def test_error_reply(self):
+        client = RedisClient(self.server.url)
+        with self.assertRaises(RedisError):
+            client.execute('HGET', 'k', 'f')
+        # The connection stays usable after an error reply
+        self.assertEqual(client.execute('SET', 'k', 'v'), 'OK')
+
+    def test_reconnects_once(self):
+        client = RedisClient(self.server.url)
+        client.execute('SET', 'k', 'v')
+        client._sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(client.execute('GET', 'k'), b'v')
+
+
+class RedisCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeRedis()
+        self.cache = RedisCache(self.server.url, ttl=60)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_put_invalidate(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', {'subject': 'hi', 'size': 3})
+        self.assertEqual(self.cache.get('a'), {'subject': 'hi', 'size': 3})
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['errors']), (1, 2, 0))
+
+    def test_clear_is_seen_by_other_workers(self):
+        other = RedisCache(self.server.url, ttl=60)
+        self.cache.put('a', 1)
+        self.assertEqual(other.get('a'), 1)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
+        other._generation_checked = 0  # as after GENERATION_REFRESH seconds
+        self.assertIsNone(other.get('a'))
+
+    def test_error_replies_are_counted(self):
+        self.cache.put('a', 1)
+        self.server.fail = 'OOM command not allowed'
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('b', 2)
+        self.cache.invalidate('a')
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['errors'], 4)
+
+    def test_unreachable_server_is_counted(self):
+        self.server.shutdown()
+        self.server.server_close()
+        cache = RedisCache(self.server.url)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        cache.invalidate('a')
+        cache.clear()
+        self.assertEqual(cache.stats()['errors'], 4)
+
+    def test_unserializable_value_is_counted(self):
+        self.cache.put('a', {'from': Header('x')})
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['errors'], 1)
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = DiskCache(os.path.join(self.tmp.name, 'cache.sqlite3'), max_bytes=1000)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_put_invalidate(self):
+        self.cache.put('a', [1, 2])
+        self.assertEqual(self.cache.get('a'), [1, 2])
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_unserializable_value_is_counted(self):
+        self.cache.put('a', {'from': Header('x')})
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['errors'], 1)
+
+    def test_evicts_least_recently_used(self):
+        for key in 'abc':
+            self.cache.put(key, 'x' * 400)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+
+class MessageCacheTest(unittest.TestCase):
+
+    def test_size_bound(self):
+        cache = MessageCache(max_bytes=100)
+        cache.put('a', 'x' * 60)
+        cache.put('b', 'y' * 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'y' * 60)
+
+
+if __name__ == '__main__':
+    unittest.main()